@@ -0,0 +1,287 @@
+"""
+Measures the latency and throughput of every route of the API through the
+Flask test client, on a dataset of 1k, 100k or 1M transactions made by
+budgethub.datagen with a fixed seed. Every GET route is requested with keys that exist in the
+dataset, and the write routes are measured last since they change it. The
+response cache is off unless --cache is given, so every request reaches the
+database.
+
+The results are written as JSON. Given a baseline, the run is compared
+against it and exits with status 1 if the p95 latency of any route got
+slower than the threshold allows.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_endpoints --size 100k
+    python -m benchmarks.bench_endpoints --size 100k --baseline before.json
+
+Building the 1M dataset takes about a minute, --database keeps it in a file
+that later runs reuse.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from flask import url_for
+
+from budgethub import create_app, db
+from budgethub.datagen import generate_data
+from budgethub.constants import *
+from budgethub.models import *
+
+SIZES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+
+#query strings of the routes that need one, and extra variants worth timing
+QUERIES = {
+    "api.transactioncollection": ["", "?sort=-price&limit=100", "?fields=price,dateTime&controls=none",
+                                  "?from=2021-03-01&to=2021-03-31"],
+    "api.categorycollection": ["", "?embed=transactions&limit=10"],
+    "api.reporttotals": ["", "?group_by=category,month"],
+    "api.searchresults": ["?q=aino", "?q=k&kind=user"],
+}
+
+
+##Measuring
+def percentile(samples, fraction):
+    #nearest-rank percentile of sorted samples
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))]
+
+def summarize(method, url, latencies, statuses):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {
+        "method": method,
+        "url": url,
+        "requests": len(latencies),
+        "statuses": sorted(set(statuses)),
+        "mean_ms": total / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_rps": len(latencies) / total if total else None
+    }
+
+def measure(client, method, requests, warmup, make_request):
+    """
+    Sends warmup unmeasured requests, then requests measured ones.
+    make_request is called with the number of the request and returns the
+    URL and the keyword arguments of the test client call.
+    """
+
+    send = getattr(client, method.lower())
+    for i in range(warmup):
+        url, kwargs = make_request(i)
+        send(url, **kwargs)
+    latencies, statuses = [], []
+    for i in range(warmup, warmup + requests):
+        url, kwargs = make_request(i)
+        began = time.perf_counter()
+        resp = send(url, **kwargs)
+        resp.get_data()
+        latencies.append(time.perf_counter() - began)
+        statuses.append(resp.status_code)
+    return summarize(method, make_request(0)[0], latencies, statuses)
+
+def in_turn(urls, **kwargs):
+    return lambda i: (urls[i % len(urls)], kwargs)
+
+def sample_keys(rng, count):
+    #a reused dataset is missing the transactions earlier runs deleted
+    last_id = db.session.query(db.func.max(Transaction.id)).scalar()
+    transaction_ids = [row_id for row_id, in db.session.query(Transaction.id).filter(
+        Transaction.id.in_(rng.sample(range(1, last_id + 1), min(last_id, 2 * count)))
+    ).order_by(Transaction.id)][:count]
+    usernames = [name for name, in db.session.query(User.username).order_by(User.id).limit(count)]
+    ibans = [iban for iban, in db.session.query(BankAccount.iban).order_by(BankAccount.id).limit(count)]
+    #the busiest category is the worst case for the category routes
+    busiest = db.session.query(transaction_category_association_table.c.categoryId) \
+        .group_by(transaction_category_association_table.c.categoryId) \
+        .order_by(db.func.count().desc()).limit(1).scalar()
+    category_names = [Category.query.get(busiest).categoryName]
+    return {
+        "transaction_id": transaction_ids,
+        "username": usernames,
+        "iban": ibans,
+        "category_name": category_names
+    }
+
+def get_routes(app, keys):
+    """
+    Returns (name, URLs) pairs for every GET route, with the URL parameters
+    filled in from the keys sampled from the dataset.
+    """
+
+    routes = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if not rule.endpoint.startswith("api.") or "GET" not in rule.methods:
+            continue
+        count = max([len(keys[name]) for name in rule.arguments] or [1])
+        urls = [
+            url_for(rule.endpoint, **{name: keys[name][i % len(keys[name])] for name in rule.arguments})
+            for i in range(count)
+        ]
+        for query in QUERIES.get(rule.endpoint, [""]):
+            routes.append(("GET " + rule.endpoint + query, [url + query for url in urls]))
+    return routes
+
+def run(app, requests, warmup, seed):
+    rng = random.Random(seed)
+    results = {}
+    client = app.test_client()
+    with app.test_request_context():
+        keys = sample_keys(rng, 50)
+        routes = get_routes(app, keys)
+        first = Category.query.count()
+
+    def record(name, result):
+        results[name] = result
+        print_result(name, result)
+
+    for name, urls in routes:
+        record(name, measure(client, "GET", requests, warmup, in_turn(urls)))
+
+    #the writes go last as they change the dataset
+    transaction = {
+        "price": 12.5, "datetime": "2021-06-01", "sender": keys["username"][0],
+        "receiver": keys["username"][1], "category": [keys["category_name"][0]]
+    }
+    record("POST api.transactioncollection", measure(
+        client, "POST", requests, 0, in_turn(["/api/transactions/"], json=transaction)
+    ))
+    record("POST api.transactionbulk", measure(
+        client, "POST", requests, 0, in_turn(["/api/transactions/bulk/"], json=[transaction] * 100)
+    ))
+    #new names on every run, a reused dataset has the categories of earlier runs
+    record("POST api.categorycollection", measure(
+        client, "POST", requests, 0,
+        lambda i: ("/api/categories/", {"json": {"category_name": "bench{}".format(first + i), "transaction": []}})
+    ))
+    #every transaction can only be deleted once
+    urls = ["/api/transactions/{}/".format(row_id) for row_id in keys["transaction_id"]]
+    record("DELETE api.transactionitem", measure(client, "DELETE", len(urls), 0, in_turn(urls)))
+    return results
+
+
+##Reporting
+def print_result(name, result, baseline=None):
+    line = "{:<66}{:>9.2f}{:>9.2f}{:>9.2f}{:>10.1f}".format(
+        name, result["p50_ms"], result["p95_ms"], result["p99_ms"], result["throughput_rps"] or 0
+    )
+    if baseline is not None:
+        line += "{:>+9.0%}".format(result["p95_ms"] / baseline["p95_ms"] - 1)
+    print(line)
+
+def metadata(size, seed, args):
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "size": size,
+        "seed": seed,
+        "requests": args.requests,
+        "cache": args.cache,
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "date": datetime.now().isoformat(timespec="seconds")
+    }
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every route's p95 latency against the baseline.
+
+    : return: names of the routes that got slower than threshold allows
+    """
+
+    print()
+    print("{:<66}{:>9}{:>9}{:>9}{:>10}{:>9}".format("compared to baseline", "p50 ms", "p95 ms", "p99 ms", "req/s", "p95"))
+    regressions = []
+    for name, result in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        print_result(name, result, before)
+        if result["p95_ms"] > before["p95_ms"] * threshold:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", default="1k", help="1k, 100k, 1m or a number of transactions")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="processes generating the dataset")
+    parser.add_argument("--cache", action="store_true", help="keep the response cache on")
+    parser.add_argument("--database", help="SQLite file to keep the dataset in and reuse")
+    parser.add_argument("--output", help="where to write the results, "
+                                         "benchmarks/results/endpoints-<size>.json by default")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="p95 ratio to the baseline that counts as a regression")
+    args = parser.parse_args(argv)
+
+    size = SIZES.get(args.size.lower()) or int(args.size)
+    fd = None
+    if args.database:
+        path = os.path.abspath(args.database)
+        reuse = os.path.exists(path)
+    else:
+        fd, path = tempfile.mkstemp()
+        reuse = False
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + path,
+        "RESPONSE_CACHE_ENABLED": args.cache
+    })
+
+    try:
+        with app.app_context():
+            if not reuse:
+                began = time.perf_counter()
+                db.create_all()
+                #one user per 100 transactions
+                generate_data(users=max(20, size // 100), categories=50, transactions=size,
+                              seed=args.seed, workers=args.workers)
+                print("Built {} transactions in {:.1f} s".format(size, time.perf_counter() - began))
+            else:
+                size = Transaction.query.count()
+                print("Reusing {} transactions from {}".format(size, path))
+            db.session.remove()
+
+            print("{:<66}{:>9}{:>9}{:>9}{:>10}".format("route", "p50 ms", "p95 ms", "p99 ms", "req/s"))
+            results = run(app, args.requests, args.warmup, args.seed)
+            db.session.remove()
+            db.get_engine().dispose()
+    finally:
+        if fd is not None:
+            os.close(fd)
+            os.unlink(path)
+
+    output = args.output or os.path.join("benchmarks", "results", "endpoints-{}.json".format(args.size.lower()))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"meta": metadata(size, args.seed, args), "results": results}, f, indent=2, sort_keys=True)
+    print("Results written to {}".format(output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("p95 regressed more than {:.0%} on: {}".format(args.threshold - 1, ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
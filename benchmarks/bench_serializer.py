@@ -0,0 +1,128 @@
+"""
+Compares building the items of the collection resources the old way, with a
+builder object and url_for calls per ORM instance, against the row tuple
+serializers in budgethub.utils. Both are encoded with encode_json, so only
+the serializers are compared, and must decode to the same items. The items
+of the row serializers are then encoded with every JSON backend to show the
+gain of the encoder on its own.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_serializer [transactions] [rounds]
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from flask import url_for
+
+from budgethub import create_app, db
+from budgethub.constants import *
+from budgethub.models import *
+from budgethub.utils import *
+
+def builder_transaction_items(transactions):
+    items = []
+    for transaction in transactions:
+        item = TransactionBuilder(
+            id=transaction.id,
+            price=transaction.price,
+            dateTime=transaction.dateTime.isoformat(),
+            sender=transaction.sender.username if transaction.sender else "Null",
+            receiver=transaction.receiver.username if transaction.receiver else "Null",
+            category=[cat.categoryName for cat in transaction.category]
+        )
+        item.add_control("self", url_for("api.transactionitem", transaction_id=transaction.id))
+        item.add_control("profile", TRANSACTION_PROFILE)
+        items.append(item)
+    return items
+
+def builder_user_items(users):
+    items = []
+    for user in users:
+        item = UserBuilder(
+            username=user.username,
+            balance=user.balance,
+            bankAccount=[account.iban for account in user.bankAccount]
+        )
+        item.add_control("self", url_for("api.useritem", username=user.username))
+        item.add_control("profile", USER_PROFILE)
+        items.append(item)
+    return items
+
+def populate(count):
+    random.seed(0)
+    accounts = [BankAccount(iban="FI{:04}".format(i), bankName="Bank") for i in range(200)]
+    users = [User(username="user{}".format(i), password="password", bankAccount=[accounts[i]])
+             for i in range(200)]
+    categories = [Category(categoryName="category{}".format(i)) for i in range(20)]
+    db.session.add_all(accounts + users + categories)
+    db.session.flush()
+    start = datetime(2021, 1, 1)
+    for i in range(count):
+        db.session.add(Transaction(
+            price=round(random.uniform(1, 100), 2),
+            dateTime=start + timedelta(minutes=i),
+            sender=random.choice(users),
+            receiver=random.choice(users),
+            category=random.sample(categories, random.randint(0, 2))
+        ))
+    db.session.commit()
+    db.session.expunge_all()
+
+def measure(name, before, after, rounds):
+    assert json.loads(encode_json(before())) == json.loads(encode_json(after())), name
+    old = min(timeit.repeat(lambda: encode_json(before()), number=1, repeat=rounds))
+    new = min(timeit.repeat(lambda: encode_json(after()), number=1, repeat=rounds))
+    print("{:<14}{:>12.1f}{:>12.1f}{:>9.1f}x".format(name, old * 1000, new * 1000, old / new))
+
+def measure_encoders(name, items, rounds):
+    # the backends may write some floats differently, the values are the same
+    times = {}
+    for backend, dumps in JSON_BACKENDS.items():
+        assert json.loads(dumps(items)) == json.loads(JSON_BACKENDS["json"](items)), (name, backend)
+        times[backend] = min(timeit.repeat(lambda: dumps(items), number=1, repeat=rounds))
+    print("{:<14}{}".format(name, "".join(
+        "{:>12.1f}{:>9.1f}x".format(elapsed * 1000, times["json"] / elapsed) for elapsed in times.values()
+    )))
+
+def main(count, rounds):
+    fd, path = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + path})
+    try:
+        with app.app_context(), app.test_request_context():
+            db.create_all()
+            populate(count)
+            print("{:<14}{:>12}{:>12}{:>10}".format("collection", "builder ms", "rows ms", "speedup"))
+            measure(
+                "transactions",
+                lambda: builder_transaction_items(transaction_query().all()),
+                lambda: list(transaction_items(transaction_rows().all())),
+                rounds
+            )
+            measure(
+                "users",
+                lambda: builder_user_items(user_query().all()),
+                lambda: user_items(user_rows()),
+                rounds
+            )
+            print()
+            print("{:<14}{}".format("encoder", "".join(
+                "{:>12}{:>10}".format(backend + " ms", "speedup") for backend in JSON_BACKENDS
+            )))
+            measure_encoders("transactions", list(transaction_items(transaction_rows().all())), rounds)
+            measure_encoders("users", user_items(user_rows()), rounds)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    )
@@ -0,0 +1,40 @@
+"""
+Compares the per-request cost of validating request bodies with
+jsonschema.validate, which checks the schema and builds a new validator on
+every call, against the precompiled validators of the schema registry.
+
+Run from the root of the repository:
+
+    python -m benchmarks.bench_validation [rounds]
+"""
+
+import sys
+import timeit
+
+from jsonschema import validate
+
+from budgethub import create_app
+from budgethub.utils import *
+
+DOCUMENTS = {
+    "transaction": (TransactionBuilder.transaction_schema, {
+        "price": 12.5, "datetime": "2021-04-03", "sender": "user1",
+        "receiver": "user2", "category": ["food"]
+    }),
+    "create-user": (UserBuilder.create_user_schema, {
+        "username": "user1", "password": "secret", "bankAccount": ["FI01"]
+    }),
+    "category": (CategoryBuilder.category_schema, {"category_name": "food"}),
+    "bank-account": (BankAccountBuilder.bank_account_schema, {"iban": "FI01", "bankName": "Bank"})
+}
+
+def main(rounds):
+    create_app()
+    print("{:<14}{:>14}{:>14}{:>10}".format("schema", "validate us", "registry us", "speedup"))
+    for name, (build, document) in DOCUMENTS.items():
+        before = timeit.timeit(lambda: validate(document, build()), number=rounds) / rounds
+        after = timeit.timeit(lambda: schema_registry.validate(name, document), number=rounds) / rounds
+        print("{:<14}{:>14.1f}{:>14.1f}{:>9.1f}x".format(name, before * 1e6, after * 1e6, before / after))
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
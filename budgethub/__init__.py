@@ -1,10 +1,33 @@
 import os
-import json
 from flask import Flask, Response
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from budgethub.cache import response_cache
+from budgethub.compression import compression
+from budgethub.metrics import metrics
+from budgethub.profiler import profiler
+from budgethub.replica import RoutingSQLAlchemy, read_replica
 from budgethub.constants import *
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# Engine options for a SQLite database file shared by several worker
+# processes. SQLite connections are cheap but the page cache and memory
+# map of a connection are lost when it's closed, so connections are pooled
+# instead of opened per request. The pragmas of every new connection are
+# set from SQLITE_PRAGMAS in models.set_sqlite_pragmas.
+SQLITE_ENGINE_OPTIONS = {
+    "poolclass": QueuePool,
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_recycle": 3600,
+    "pool_pre_ping": False,
+    "connect_args": {"check_same_thread": False}
+}
+
+def _is_sqlite_file(uri):
+    url = make_url(uri)
+    return url.drivername.startswith("sqlite") and url.database not in (None, "", ":memory:")
 
 # Based on http://flask.pocoo.org/docs/1.0/tutorial/factory/#the-application-factory
 # Modified to use Flask SQLAlchemy
@@ -12,8 +35,15 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY="dev",
-        SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_DATABASE_URI=os.environ.get(
+            "BUDGETHUB_DATABASE_URI",
+            "sqlite:///" + os.path.join(app.instance_path, "development.db")
+        ),
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        READ_REPLICA_URI=os.environ.get("BUDGETHUB_READ_REPLICA_URI"),
+        SQLITE_PRAGMAS=dict(SQLITE_PRAGMAS),
+        BULK_CHUNK_SIZE=BULK_CHUNK_SIZE,
+        METRICS_DIR=os.environ.get("BUDGETHUB_METRICS_DIR")
     )
 
     if test_config is None:
@@ -21,18 +51,37 @@ def create_app(test_config=None):
     else:
         app.config.from_mapping(test_config)
 
+    if _is_sqlite_file(app.config["SQLALCHEMY_DATABASE_URI"]):
+        # options of the config are changed one by one, the rest are kept
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **SQLITE_ENGINE_OPTIONS, **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        }
+
     try:
         os.makedirs(app.instance_path)
     except OSError:
         pass
 
     db.init_app(app)
+    # first so it times the whole request and sees the final response size
+    metrics.init_app(app)
+    profiler.init_app(app)
+    read_replica.init_app(app)
+    response_cache.init_app(app)
+    compression.init_app(app)
 
     from . import models
+    from . import migrations
+    from . import datagen
     from . import api
     app.cli.add_command(models.init_db_command)
-    # app.cli.add_command(models.generate_test_data)
+    app.cli.add_command(models.rebuild_rollups_command)
+    app.cli.add_command(models.verify_balances_command)
+    app.cli.add_command(migrations.db_upgrade_command)
+    app.cli.add_command(migrations.db_downgrade_command)
+    app.cli.add_command(datagen.generate_data_command)
     app.register_blueprint(api.api_bp)
+    utils.schema_registry.compile()
 
     @app.route(LINK_RELATIONS_URL)
     def send_link_relations():
@@ -50,7 +99,17 @@ def create_app(test_config=None):
         body.add_control("bumeta:users-all", "/api/users/", method="GET")
         body.add_control("bumeta:bankaccounts-all", "/api/bankaccounts/", method="GET")
         body.add_control("bumeta:categories-all", "/api/categories/", method="GET")
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return utils.mason_response(body)
+
+    @app.route("/api/cache/")
+    def cache_stats():
+        body = utils.MasonBuilder(response_cache.stats())
+        body.add_control("self", "/api/cache/")
+        return utils.mason_response(body)
+
+    @app.route("/metrics")
+    def metrics_page():
+        return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
 
     @app.route("/admin/")
     def admin_site():
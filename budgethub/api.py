@@ -1,10 +1,13 @@
 from flask import Blueprint
 from flask_restful import Api
 
-from budgethub.resources.transaction import TransactionCollection, TransactionItem
+from budgethub.resources.transaction import TransactionCollection, TransactionItem, \
+    TransactionBulk, CategoryTransactionCollection, UserTransactionCollection
 from budgethub.resources.category import CategoryCollection, CategoryItem
 from budgethub.resources.user import UserCollection, UserItem
 from budgethub.resources.bank_account import BankAccountCollection, BankAccountItem
+from budgethub.resources.report import ReportTotals
+from budgethub.resources.search import SearchResults
 
 api_bp = Blueprint("api", __name__, url_prefix="/api/")
 api = Api(api_bp)
@@ -12,16 +15,25 @@ api = Api(api_bp)
 ##Routing
 #transactions routing
 api.add_resource(TransactionCollection, "/transactions/")
+api.add_resource(TransactionBulk, "/transactions/bulk/")
 api.add_resource(TransactionItem, "/transactions/<transaction_id>/")
 
 #categories routing
 api.add_resource(CategoryCollection, "/categories/")
 api.add_resource(CategoryItem, "/categories/<category_name>/")
+api.add_resource(CategoryTransactionCollection, "/categories/<category_name>/transactions/")
 
 #users routing
 api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<username>/")
+api.add_resource(UserTransactionCollection, "/users/<username>/transactions/")
 
 #bank account routing
 api.add_resource(BankAccountCollection, "/bankaccounts/")
-api.add_resource(BankAccountItem, "/bankaccounts/<iban>/")
\ No newline at end of file
+api.add_resource(BankAccountItem, "/bankaccounts/<iban>/")
+
+#reports routing
+api.add_resource(ReportTotals, "/reports/totals/")
+
+#search routing
+api.add_resource(SearchResults, "/search/")
\ No newline at end of file
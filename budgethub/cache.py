@@ -0,0 +1,127 @@
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+
+class CachedResponse(object):
+    """
+    A rendered response body together with what is needed to send it again
+    and to find out when it has become stale.
+    """
+
+    def __init__(self, body, mimetype, tables):
+        self.body = body
+        self.mimetype = mimetype
+        self.tables = frozenset(tables)
+
+
+class ResponseCache(object):
+    """
+    In-process LRU cache of rendered GET responses, limited by the total size
+    of the cached bodies. Entries are keyed by the ETag of the response,
+    which already covers the path, the query string, the media type and the
+    change counters of every table the response is built from. A write in
+    another worker process therefore never serves a stale entry here, it only
+    makes the old entry unreachable. Writes in this process additionally
+    evict every entry built from the written tables straight away, so the
+    memory is given back to fresher entries.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RESPONSE_CACHE_ENABLED", True)
+        app.config.setdefault("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+        app.config.setdefault("RESPONSE_CACHE_MAX_ENTRY_BYTES", 4 * 1024 * 1024)
+
+    @staticmethod
+    def enabled():
+        return current_app.config["RESPONSE_CACHE_ENABLED"]
+
+    def get(self, key):
+        """
+        Returns the cached response for the key and marks it as the most
+        recently used one, or None if it isn't cached.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, response, tables):
+        """
+        Caches the body of a response. Streamed responses and bodies larger
+        than RESPONSE_CACHE_MAX_ENTRY_BYTES are not cached. Least recently
+        used entries are evicted until the cache fits in its memory budget.
+
+        : param key: cache key, see the class docstring
+        : param response: the rendered response
+        : param tables: names of the tables the response is built from
+        """
+
+        if response.is_streamed:
+            return
+        body = response.get_data()
+        max_bytes = current_app.config["RESPONSE_CACHE_MAX_BYTES"]
+        if len(body) > min(max_bytes, current_app.config["RESPONSE_CACHE_MAX_ENTRY_BYTES"]):
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self.entries[key] = CachedResponse(body, response.mimetype, tables)
+            self.size += len(body)
+            while self.size > max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        """
+        Drops every entry built from one of the given tables.
+        """
+
+        tables = set(tables)
+        with self.lock:
+            stale = [key for key, entry in self.entries.items() if entry.tables & tables]
+            for key in stale:
+                self.size -= len(self.entries.pop(key).body)
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": current_app.config["RESPONSE_CACHE_MAX_BYTES"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,110 @@
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from budgethub.constants import *
+
+
+class Compression(object):
+    """
+    Compresses responses with gzip, or brotli when it's installed, if the
+    client accepts it. Only text formats listed in COMPRESS_MIMETYPES are
+    compressed, so images and archives are sent as they are. Streamed
+    responses are compressed chunk by chunk and every chunk is flushed, so
+    the client still receives the items as they are written.
+
+    Compressed responses get their own strong ETag by appending the encoding
+    to the tag, see etag_variants.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+        app.config.setdefault("COMPRESS_MIMETYPES", [
+            MASON, NDJSON, "application/json", "text/html", "text/css",
+            "text/plain", "text/javascript", "application/javascript"
+        ])
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def encodings():
+        return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def compressor(self, encoding, config):
+        if encoding == "br":
+            return brotli.Compressor(quality=config["COMPRESS_BROTLI_QUALITY"])
+        # wbits 31 writes a gzip header and trailer around the deflate stream
+        return zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, 31)
+
+    def after_request(self, response):
+        config = current_app.config
+
+        # a partial response must stay the bytes its Content-Range names
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or "Content-Range" in response.headers
+                or response.mimetype not in config["COMPRESS_MIMETYPES"]
+                or "Content-Encoding" in response.headers):
+            return response
+        response.vary.add("Accept-Encoding")
+
+        encoding = request.accept_encodings.best_match(self.encodings())
+        if encoding is None:
+            return response
+
+        if response.direct_passthrough:
+            # a static file, read it in instead of sending it straight from the file
+            response.direct_passthrough = False
+            response.make_sequence()
+        if response.is_streamed:
+            response.response = self._compress_stream(
+                response.iter_encoded(), self.compressor(encoding, config), encoding
+            )
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < config["COMPRESS_MIN_SIZE"]:
+                return response
+            compressor = self.compressor(encoding, config)
+            if encoding == "br":
+                response.set_data(compressor.process(data) + compressor.finish())
+            else:
+                response.set_data(compressor.compress(data) + compressor.flush())
+
+        response.headers["Content-Encoding"] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag("{}-{}".format(etag, encoding), weak)
+        return response
+
+    @staticmethod
+    def _compress_stream(chunks, compressor, encoding):
+        for chunk in chunks:
+            if encoding == "br":
+                data = compressor.process(chunk) + compressor.flush()
+            else:
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.finish() if encoding == "br" else compressor.flush()
+
+
+def etag_variants(etag):
+    """
+    Returns the ETags a client may hold for the representation with the
+    given tag: the tag itself and its compressed variants.
+    """
+
+    return [etag] + ["{}-{}".format(etag, encoding) for encoding in Compression.encodings()]
+
+
+compression = Compression()
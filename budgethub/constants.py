@@ -1,8 +1,62 @@
 ##URL constants
 MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
 ERROR_PROFILE = "/profiles/error/"
 LINK_RELATIONS_URL = "/bumeta/link-relations/"
 TRANSACTION_PROFILE = "/profiles/transaction/"
 CATEGORY_PROFILE = "/profiles/category/"
 USER_PROFILE = "/profiles/user/"
-BANK_ACCOUNT_PROFILE = "/profiles/bank-account/"
\ No newline at end of file
+BANK_ACCOUNT_PROFILE = "/profiles/bank-account/"
+REPORT_PROFILE = "/profiles/report/"
+
+##Pagination constants
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+#rows fetched from the database at a time when streaming a collection
+STREAM_BATCH_SIZE = 1000
+
+##Bulk ingest constants
+BULK_CHUNK_SIZE = 1000
+#SQLite's default limit for bound parameters in one statement is 999
+IN_CLAUSE_BATCH = 500
+
+##Embedding constants
+#transactions shown per category with ?embed=transactions
+DEFAULT_EMBED_LIMIT = 10
+MAX_EMBED_LIMIT = 100
+
+##Search constants
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 50
+#matches ranked per query, see models.search
+SEARCH_CANDIDATES = 500
+#kinds of search results and the item endpoints they link to
+SEARCH_KINDS = {
+    "user": ("api.useritem", "username", USER_PROFILE),
+    "category": ("api.categoryitem", "category_name", CATEGORY_PROFILE),
+    "bankaccount": ("api.bankaccountitem", "iban", BANK_ACCOUNT_PROFILE)
+}
+
+##Schema constants
+#version of the schema created by init-db, the last migration in migrations.py
+SCHEMA_VERSION = 6
+
+##Sparse fieldset constants
+#fields of the collection items in the order they are written
+TRANSACTION_FIELDS = ("id", "price", "dateTime", "sender", "receiver", "category")
+USER_FIELDS = ("username", "balance", "bankAccount")
+CATEGORY_FIELDS = ("category_name", "transaction_count")
+BANK_ACCOUNT_FIELDS = ("iban", "bankName", "user")
+
+##SQLite constants
+#applied to every new connection, foreign keys are always turned on
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    #negative sizes are in KiB, 64 MiB
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "foreign_keys": "ON"
+}
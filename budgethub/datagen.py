@@ -0,0 +1,217 @@
+import bisect
+import itertools
+import multiprocessing
+import random
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import inspect
+
+from budgethub import db
+from budgethub.models import *
+from budgethub.migrations import LOOKUP_INDEXES, create_indexes, drop_indexes, month_ranges
+
+# Synthetic data for development databases and load testing. Everything is
+# drawn from random.Random instances seeded with the seed and the name of
+# what is generated, and the transactions are generated in chunks of
+# GENERATE_CHUNK_SIZE with a generator of their own. The same options and
+# seed therefore give the same rows, whether the chunks are generated in one
+# process or in many. Popular categories and users are drawn with Zipf-like
+# weights: the k:th most popular is chosen 1 / k ** skew times as often as
+# the most popular one, skew 0 giving a uniform draw.
+
+GENERATE_CHUNK_SIZE = 50000
+
+FIRST_NAMES = ["aino", "eino", "helmi", "juho", "kaisa", "lauri", "maija", "niko", "olli", "pirjo",
+               "sanna", "teemu", "ulla", "veikko", "emilia", "onni", "aada", "leevi", "sofia", "elias"]
+LAST_NAMES = ["korhonen", "virtanen", "makinen", "nieminen", "makela", "hamalainen", "laine", "heikkinen",
+              "koskinen", "jarvinen", "lehtonen", "lehtinen", "saarinen", "salminen", "heinonen", "niemi"]
+CATEGORY_NAMES = ["groceries", "rent", "transport", "restaurants", "electricity", "insurance", "clothes",
+                  "travel", "health", "phone", "internet", "sports", "gifts", "books", "games", "pets"]
+BANK_NAMES = ["Nordea", "OP", "Danske Bank", "S-Pankki", "Aktia", "POP Pankki", "Handelsbanken"]
+
+
+##Generators
+@lru_cache(maxsize=8)
+def zipf_weights(count, skew):
+    """
+    Cumulative Zipf-like weights of the ids 1 ... count, for
+    random.choices and bisect.
+    """
+
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, count + 1)))
+
+def generate_usernames(seed, count):
+    #numbered so every name is unique, e.g. aino.korhonen17
+    rng = random.Random("{}-users".format(seed))
+    return ["{}.{}{}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), i + 1) for i in range(count)]
+
+def generate_category_names(count):
+    #groceries ... pets, then groceries2 ... pets2 and so on
+    names = []
+    for i in range(count):
+        round_number = i // len(CATEGORY_NAMES) + 1
+        names.append(CATEGORY_NAMES[i % len(CATEGORY_NAMES)] + (str(round_number) if round_number > 1 else ""))
+    return names
+
+def generate_transactions(spec, chunk):
+    """
+    Generates the transactions of one chunk. Runs in the worker processes,
+    so it only depends on its arguments.
+
+    : param dict spec: the options of the generated dataset
+    : param int chunk: number of the chunk, its first id is
+    chunk * GENERATE_CHUNK_SIZE + 1
+    : return: (transaction rows, category link rows)
+    """
+
+    rng = random.Random("{}-transactions-{}".format(spec["seed"], chunk))
+    first = chunk * GENERATE_CHUNK_SIZE + 1
+    last = min(spec["transactions"], first + GENERATE_CHUNK_SIZE - 1)
+    count = last - first + 1
+    users = range(1, spec["users"] + 1)
+    user_weights = zipf_weights(spec["users"], spec["skew"])
+    category_weights = zipf_weights(spec["categories"], spec["skew"])
+    senders = rng.choices(users, cum_weights=user_weights, k=count)
+    receivers = rng.choices(users, cum_weights=user_weights, k=count)
+    seconds = spec["days"] * 24 * 60 * 60
+
+    transactions, links = [], []
+    for transaction_id, sender, receiver in zip(range(first, last + 1), senders, receivers):
+        if receiver == sender and spec["users"] > 1:
+            receiver = receiver % spec["users"] + 1
+        transactions.append({
+            "id": transaction_id,
+            "price": round(min(rng.lognormvariate(3, 1), 10000), 2),
+            "dateTime": spec["date_from"] + timedelta(seconds=rng.randrange(seconds)),
+            "senderId": sender,
+            "receiverId": receiver
+        })
+        #most transactions have one category, some two and some none
+        categories = set()
+        for probability in (0.9, 0.2):
+            if rng.random() < probability:
+                categories.add(bisect.bisect(category_weights, rng.random() * category_weights[-1]) + 1)
+        for category_id in sorted(categories):
+            links.append({"transactionId": transaction_id, "categoryId": category_id})
+    return transactions, links
+
+def _generate_chunk(args):
+    return generate_transactions(*args)
+
+
+##Loading
+def _insert(table, rows):
+    size = current_app.config["BULK_CHUNK_SIZE"]
+    for i in range(0, len(rows), size):
+        db.session.execute(table.insert(), rows[i:i + size])
+
+def generate_data(users=1000, accounts=None, categories=20, transactions=100000,
+                  date_from=datetime(2021, 1, 1), days=365, skew=1.0, seed=0, workers=1, echo=None):
+    """
+    Fills an empty database with generated users, bank accounts, categories
+    and transactions. The rows are inserted with executemany, the lookup
+    indexes of the transactions are dropped for the load and rebuilt at the
+    end, and then the balances, the spending rollup and the planner
+    statistics are computed from the inserted rows.
+
+    : param int accounts: number of bank accounts, the same as users by
+    default. Account n belongs to user n, the extra ones are shared out
+    from the first user on.
+    : param int workers: processes generating transactions, the inserts are
+    always done by this one
+    : param echo: function called with progress messages
+    """
+
+    accounts = users if accounts is None else accounts
+    if users < 1 or categories < 1 or accounts < 0 or transactions < 0 or days < 1:
+        raise ValueError("There must be at least one user, one category and one day")
+    if User.query.first() is not None or Category.query.first() is not None:
+        raise ValueError("The database already has data")
+    echo = echo or (lambda message: None)
+
+    _insert(User.__table__, [
+        {"id": i + 1, "username": username, "password": "password", "balance": 0}
+        for i, username in enumerate(generate_usernames(seed, users))
+    ])
+    rng = random.Random("{}-accounts".format(seed))
+    _insert(BankAccount.__table__, [
+        {"id": i + 1, "iban": "FI{:02d}{:014d}".format(rng.randrange(100), i + 1), "bankName": rng.choice(BANK_NAMES)}
+        for i in range(accounts)
+    ])
+    _insert(bankaccount_user_association_table, [
+        {"bankAccountId": i + 1, "userId": i % users + 1} for i in range(accounts)
+    ])
+    _insert(Category.__table__, [
+        {"id": i + 1, "categoryName": name}
+        for i, name in enumerate(generate_category_names(categories))
+    ])
+    db.session.commit()
+    echo("Generated {} users, {} bank accounts and {} categories".format(users, accounts, categories))
+
+    spec = {
+        "users": users, "categories": categories, "transactions": transactions,
+        "date_from": date_from, "days": days, "skew": skew, "seed": seed
+    }
+    chunks = [(spec, chunk) for chunk in range((transactions + GENERATE_CHUNK_SIZE - 1) // GENERATE_CHUNK_SIZE)]
+    drop_indexes(LOOKUP_INDEXES)
+    db.session.commit()
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(chunks) > 1 else None
+    try:
+        results = pool.imap(_generate_chunk, chunks) if pool else map(_generate_chunk, chunks)
+        inserted = 0
+        for rows, links in results:
+            _insert(Transaction.__table__, rows)
+            _insert(transaction_category_association_table, links)
+            db.session.commit()
+            inserted += len(rows)
+            echo("Inserted {} of {} transactions".format(inserted, transactions))
+    finally:
+        if pool:
+            pool.terminate()
+        create_indexes(LOOKUP_INDEXES)
+        db.session.commit()
+
+    db.session.execute(User.__table__.update().where(User.id == db.bindparam("user_id")).values(
+        balance=db.bindparam("new_balance")
+    ), [{"user_id": user_id, "new_balance": balance} for user_id, balance in computed_balances().items()])
+    db.session.commit()
+    for month_from, month_to in month_ranges():
+        rebuild_rollups(month_from, month_to)
+        db.session.commit()
+    bump_table_versions(User, BankAccount, Category, Transaction, SpendingRollup)
+    db.session.commit()
+    db.session.execute("ANALYZE")
+    db.session.commit()
+    echo("Computed the balances and the spending rollup")
+
+
+## command line commands
+@click.command("generate-data")
+@click.option("--users", type=click.IntRange(1), default=1000, show_default=True)
+@click.option("--accounts", type=click.IntRange(0), default=None, help="Bank accounts, as many as users by default.")
+@click.option("--categories", type=click.IntRange(1), default=20, show_default=True)
+@click.option("--transactions", type=click.IntRange(0), default=100000, show_default=True)
+@click.option("--from", "date_from", type=click.DateTime(["%Y-%m-%d"]), default="2021-01-01", show_default=True,
+              help="Date of the first transactions.")
+@click.option("--days", type=click.IntRange(1), default=365, show_default=True,
+              help="Number of days the transactions are spread over.")
+@click.option("--skew", type=click.FloatRange(0), default=1.0, show_default=True,
+              help="Zipf exponent of the popularity of categories and users, 0 for uniform.")
+@click.option("--seed", type=int, default=0, show_default=True)
+@click.option("--workers", type=click.IntRange(0), default=1, show_default=True,
+              help="Processes generating transactions, 0 for one per CPU.")
+@with_appcontext
+def generate_data_command(users, accounts, categories, transactions, date_from, days, skew, seed, workers):
+    if "transaction" not in inspect(db.engine).get_table_names():
+        raise click.ClickException("The database has no tables, run flask init-db first")
+    try:
+        generate_data(
+            users, accounts, categories, transactions, date_from, days, skew, seed,
+            workers or multiprocessing.cpu_count(), click.echo
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
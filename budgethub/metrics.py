@@ -0,0 +1,217 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Histogram buckets, upper bounds in seconds, bytes and queries
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+COUNTERS = {
+    "budgethub_http_requests_total": "Requests by endpoint, method and status code.",
+}
+HISTOGRAMS = {
+    "budgethub_http_request_duration_seconds": ("Time from the start of a request to its response.",
+                                                LATENCY_BUCKETS),
+    "budgethub_http_response_size_bytes": ("Size of the response bodies as sent, streamed bodies left out.",
+                                           SIZE_BUCKETS),
+    "budgethub_http_request_sql_queries": ("SQL statements run per request.", QUERY_BUCKETS),
+}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_sql_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and "sql_queries" in g:
+        g.sql_queries += 1
+
+
+class Metrics(object):
+    """
+    Request counts and latency, response size and SQL query histograms per
+    endpoint, in the Prometheus text format at /metrics. Streamed responses
+    are recorded when their body has been sent, their size is left out. Recording a request
+    only takes a dictionary update under a lock, so the metrics are always
+    on.
+
+    Every worker process keeps its own numbers. When METRICS_DIR is set they
+    are written to a file of their own in that directory at most every
+    METRICS_FLUSH_INTERVAL seconds and when the process exits, and /metrics
+    adds up the files of every process, including the ones that have
+    exited, so the counters never go backwards. The directory should be
+    emptied when the server is restarted. Without METRICS_DIR only the
+    process that answers /metrics is counted.
+    """
+
+    def __init__(self, app=None):
+        self.reset()
+        if hasattr(os, "register_at_fork"):
+            # a forked worker starts counting from zero, whatever the parent had
+            os.register_at_fork(after_in_child=self.reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_DIR", None)
+        app.config.setdefault("METRICS_FLUSH_INTERVAL", 5)
+        app.before_request(self.start_request)
+        app.after_request(self.after_request)
+        if app.config["METRICS_DIR"]:
+            directory = app.config["METRICS_DIR"]
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.flush, directory)
+
+    def reset(self):
+        # also runs in a forked child, where the lock may have been held by
+        # a thread that no longer exists
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.flushed = time.monotonic()
+        # process ids get reused, a new process must not replace the file of
+        # an exited one
+        self.filename = "{}-{}.json".format(os.getpid(), uuid.uuid4().hex)
+
+    @staticmethod
+    def start_request():
+        state = g._get_current_object()
+        state.request_started = time.perf_counter()
+        state.sql_queries = 0
+
+    def after_request(self, response):
+        # the proxies are looked up once, every lookup costs a few microseconds
+        state = g._get_current_object()
+        if not hasattr(state, "request_started"):
+            return response
+        current_request = request._get_current_object()
+        labels = (current_request.endpoint or "unmatched", current_request.method)
+        config = current_app.config
+        flush = (config["METRICS_DIR"], config["METRICS_FLUSH_INTERVAL"])
+        if response.is_streamed:
+            # a streamed body runs most of its queries while it's being sent,
+            # so the request is recorded once the server has closed it
+            response.call_on_close(lambda: self.record(state, labels, response, *flush))
+        else:
+            self.record(state, labels, response, *flush)
+        return response
+
+    def record(self, state, labels, response, directory, interval):
+        elapsed = time.perf_counter() - state.request_started
+        size = None if response.is_streamed else response.calculate_content_length()
+        with self.lock:
+            key = ("budgethub_http_requests_total", labels + (str(response.status_code),))
+            self.counters[key] = self.counters.get(key, 0) + 1
+            self._observe("budgethub_http_request_duration_seconds", labels, elapsed)
+            self._observe("budgethub_http_request_sql_queries", labels, state.sql_queries)
+            if size is not None:
+                self._observe("budgethub_http_response_size_bytes", labels, size)
+
+        if directory and time.monotonic() - self.flushed >= interval:
+            self.flush(directory)
+
+    def _observe(self, name, labels, value):
+        # buckets are stored per bucket and only made cumulative for export
+        buckets = HISTOGRAMS[name][1]
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = [0] * (len(buckets) + 1) + [0]
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, list(labels), list(histogram)]
+                               for (name, labels), histogram in self.histograms.items()]
+            }
+
+    def flush(self, directory):
+        """
+        Writes the numbers of this process to <pid>-<uuid>.json in the
+        directory.
+        The file is replaced in one step, so readers never see half of it.
+        """
+
+        path = os.path.join(directory, self.filename)
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+        self.flushed = time.monotonic()
+
+    def collect(self, directory=None):
+        """
+        Adds up the numbers of this process and of the other processes that
+        have written to the directory.
+
+        : return: (counters, histograms) dicts keyed by (name, labels)
+        """
+
+        snapshots = [self.snapshot()]
+        if directory:
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith(".json") and filename != self.filename:
+                    try:
+                        with open(os.path.join(directory, filename)) as f:
+                            snapshots.append(json.load(f))
+                    except (OSError, ValueError):
+                        continue
+
+        counters, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot["histograms"]:
+                key = (name, tuple(labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    total[i] += value
+        return counters, histograms
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+
+        counters, histograms = self.collect(current_app.config["METRICS_DIR"])
+        lines = []
+        for name, help_text in COUNTERS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} counter".format(name))
+            for (key_name, labels), value in sorted(counters.items()):
+                if key_name == name:
+                    lines.append("{}{{{}}} {}".format(name, _labels(("endpoint", "method", "status"), labels), value))
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} histogram".format(name))
+            for (key_name, labels), values in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                label_text = _labels(("endpoint", "method"), labels)
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), values):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(name, label_text, _number(values[-1])))
+                lines.append("{}_count{{{}}} {}".format(name, label_text, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in zip(names, values))
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
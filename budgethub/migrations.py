@@ -0,0 +1,314 @@
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from budgethub import db
+from budgethub.models import *
+
+# Versioned schema migrations. The version of a database is kept in SQLite's
+# PRAGMA user_version, 0 being a database that has never been migrated.
+# Databases created by init-db are stamped with the latest version straight
+# away. Every step checks what already exists before it changes anything, so
+# a migration that was interrupted can simply be run again.
+
+
+##Helpers
+def schema_version():
+    return db.session.execute("PRAGMA user_version").scalar()
+
+def set_schema_version(version):
+    db.session.execute("PRAGMA user_version={:d}".format(version))
+    db.session.commit()
+
+def column_names(table):
+    return [row[1] for row in db.session.execute('PRAGMA table_info("{}")'.format(table))]
+
+def create_tables(*models):
+    for model in models:
+        model.__table__.create(bind=db.session.connection(), checkfirst=True)
+
+def drop_tables(*models):
+    for model in models:
+        model.__table__.drop(bind=db.session.connection(), checkfirst=True)
+
+def create_indexes(indexes):
+    for name, table, columns in indexes:
+        db.session.execute('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+            name, table, ", ".join('"{}"'.format(column) for column in columns)
+        ))
+
+def drop_indexes(indexes):
+    for name, table, columns in indexes:
+        db.session.execute('DROP INDEX IF EXISTS "{}"'.format(name))
+
+def id_ranges(model, batch_size):
+    """
+    Splits the ids of a table into ranges of at most batch_size rows, so
+    large tables can be rewritten one short write transaction at a time.
+
+    : return: generator of (first id, last id) pairs
+    """
+
+    last = 0
+    while True:
+        ids = [row_id for row_id, in db.session.query(model.id).filter(model.id > last)
+               .order_by(model.id).limit(batch_size)]
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        last = ids[-1]
+
+def month_ranges():
+    """
+    Splits the dates of the transactions into calendar months.
+
+    : return: generator of (first day of month, first day of next month) pairs
+    """
+
+    first, last = db.session.query(db.func.min(Transaction.dateTime), db.func.max(Transaction.dateTime)).one()
+    if first is None:
+        return
+    month = datetime(first.year, first.month, 1)
+    while month <= last:
+        next_month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+        yield month, next_month
+        month = next_month
+
+
+##Migrations
+class Migration(object):
+    """
+    One step of the schema. upgrade moves a database from version - 1 to
+    version and downgrade moves it back. Migrations without a downgrade
+    can't be undone.
+    """
+
+    def __init__(self, version, description, upgrade, downgrade=None):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.downgrade = downgrade
+
+
+BASE_TABLES = (User, BankAccount, Category, Transaction)
+
+LOOKUP_INDEXES = [
+    ("ix_transaction_price", "transaction", ["price"]),
+    ("ix_transaction_dateTime", "transaction", ["dateTime"]),
+    ("ix_transaction_senderId_dateTime", "transaction", ["senderId", "dateTime"]),
+    ("ix_transaction_receiverId_dateTime", "transaction", ["receiverId", "dateTime"]),
+    ("ix_transaction_category_categoryId", "transaction_category_association_table",
+     ["categoryId", "transactionId"]),
+]
+
+def create_base_tables():
+    create_tables(*BASE_TABLES)
+    for table in (bankaccount_user_association_table, transaction_category_association_table):
+        table.create(bind=db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+def add_lookup_indexes():
+    create_indexes(LOOKUP_INDEXES)
+    db.session.commit()
+
+def remove_lookup_indexes():
+    drop_indexes(LOOKUP_INDEXES)
+    db.session.commit()
+
+def add_rollups():
+    """
+    Creates the change counters and the spending rollup, then fills the
+    rollup one month of transactions at a time.
+    """
+
+    create_tables(TableVersion, SpendingRollup)
+    db.session.commit()
+    for date_from, date_to in month_ranges():
+        rebuild_rollups(date_from, date_to)
+        db.session.commit()
+    bump_table_versions(SpendingRollup)
+    db.session.commit()
+
+def remove_rollups():
+    drop_tables(SpendingRollup, TableVersion)
+    db.session.commit()
+
+def add_balances():
+    """
+    Adds the balance column of the users and computes it from the
+    transactions for BULK_CHUNK_SIZE users at a time.
+    """
+
+    if "balance" not in column_names("user"):
+        db.session.execute('ALTER TABLE "user" ADD COLUMN balance FLOAT NOT NULL DEFAULT 0')
+        db.session.commit()
+
+    received = db.select([db.func.coalesce(db.func.sum(Transaction.price), 0)]) \
+        .where(Transaction.receiverId == User.id).as_scalar()
+    sent = db.select([db.func.coalesce(db.func.sum(Transaction.price), 0)]) \
+        .where(Transaction.senderId == User.id).as_scalar()
+    for first, last in id_ranges(User, current_app.config["BULK_CHUNK_SIZE"]):
+        User.query.filter(User.id.between(first, last)).update(
+            {User.balance: received - sent}, synchronize_session=False
+        )
+        db.session.commit()
+    bump_table_versions(User)
+    db.session.commit()
+
+def remove_balances():
+    """
+    Rebuilds the user table without the balance column, since ALTER TABLE
+    ... DROP COLUMN needs SQLite 3.35. The rows are copied to a new table
+    that then takes the place of the old one, with the foreign keys off so
+    dropping the old table doesn't touch the rows that refer to the users.
+    """
+
+    if "balance" not in column_names("user"):
+        return
+    db.session.commit()
+    columns = [column.copy() for column in User.__table__.columns if column.name != "balance"]
+    rebuilt = db.Table("user_rebuilt", db.MetaData(), *columns)
+    names = ", ".join('"{}"'.format(column.name) for column in columns)
+    with db.engine.connect() as connection:
+        # the pragma is ignored inside a transaction
+        connection.execute("PRAGMA foreign_keys = OFF")
+        try:
+            with connection.begin():
+                # pysqlite only opens a transaction for DML, not for DDL
+                connection.execute("BEGIN")
+                rebuilt.create(bind=connection)
+                connection.execute('INSERT INTO user_rebuilt ({0}) SELECT {0} FROM "user"'.format(names))
+                connection.execute('DROP TABLE "user"')
+                connection.execute('ALTER TABLE user_rebuilt RENAME TO "user"')
+        finally:
+            connection.execute("PRAGMA foreign_keys = ON")
+
+def add_search_index():
+    """
+    Creates the search index and its triggers, then indexes the existing
+    rows BULK_CHUNK_SIZE at a time.
+    """
+
+    for statement in search_index_ddl():
+        db.session.execute(statement)
+    db.session.commit()
+    for kind, code, table, name, text in SEARCH_SOURCES:
+        model = {"user": User, "category": Category, "bankaccount": BankAccount}[kind]
+        for first, last in id_ranges(model, current_app.config["BULK_CHUNK_SIZE"]):
+            index_search_rows(kind, first, last)
+            db.session.commit()
+
+def remove_search_index():
+    for kind, code, table, name, text in SEARCH_SOURCES:
+        for trigger in ("insert", "update", "delete"):
+            db.session.execute("DROP TRIGGER IF EXISTS search_{}_{}".format(kind, trigger))
+    db.session.execute("DROP TABLE IF EXISTS search_index")
+    db.session.commit()
+
+def add_unique_rollup_groups():
+    """
+    Merges the rollup rows that share a group, left behind by deleted
+    senders, and makes the group index unique so there is one row per
+    group from then on.
+    """
+
+    merged = db.session.query(
+        db.func.min(SpendingRollup.id), db.func.sum(SpendingRollup.total), db.func.sum(SpendingRollup.count),
+        *ROLLUP_GROUP
+    ).group_by(*ROLLUP_GROUP).having(db.func.count() > 1).all()
+    for row_id, total, count, *key in merged:
+        group = [column == value for column, value in zip(ROLLUP_GROUP, key)]
+        SpendingRollup.query.filter(SpendingRollup.id != row_id, *group).delete(synchronize_session=False)
+        SpendingRollup.query.filter_by(id=row_id).update(
+            {SpendingRollup.total: total, SpendingRollup.count: count}, synchronize_session=False
+        )
+    db.session.execute('DROP INDEX IF EXISTS "ix_spending_rollup_group"')
+    index, = [index for index in SpendingRollup.__table__.indexes if index.name == "ix_spending_rollup_group"]
+    index.create(bind=db.session.connection())
+    bump_table_versions(SpendingRollup)
+    db.session.commit()
+
+def remove_unique_rollup_groups():
+    db.session.execute('DROP INDEX IF EXISTS "ix_spending_rollup_group"')
+    create_indexes([("ix_spending_rollup_group", "spending_rollup", ["month", "userId", "categoryId"])])
+    db.session.commit()
+
+
+MIGRATIONS = [
+    Migration(1, "base tables", create_base_tables),
+    Migration(2, "transaction lookup indexes", add_lookup_indexes, remove_lookup_indexes),
+    Migration(3, "change counters and spending rollup", add_rollups, remove_rollups),
+    Migration(4, "user balances", add_balances, remove_balances),
+    Migration(5, "search index", add_search_index, remove_search_index),
+    Migration(6, "one spending rollup row per group", add_unique_rollup_groups, remove_unique_rollup_groups),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def upgrade(target=LATEST_VERSION):
+    """
+    Runs the migrations after the current version up to target, then
+    refreshes the statistics of the query planner.
+
+    : return: list of the migrations that were run
+    """
+
+    current = schema_version()
+    applied = []
+    for migration in MIGRATIONS:
+        if current < migration.version <= target:
+            migration.upgrade()
+            set_schema_version(migration.version)
+            applied.append(migration)
+    analyze()
+    return applied
+
+def downgrade(target):
+    """
+    Undoes the migrations after target, newest first.
+
+    : return: list of the migrations that were undone
+    """
+
+    current = schema_version()
+    undone = []
+    for migration in reversed(MIGRATIONS):
+        if target < migration.version <= current:
+            if migration.downgrade is None:
+                raise ValueError("Migration {} ({}) can't be undone".format(
+                    migration.version, migration.description
+                ))
+            migration.downgrade()
+            set_schema_version(migration.version - 1)
+            undone.append(migration)
+    return undone
+
+def analyze():
+    db.session.execute("ANALYZE")
+    db.session.commit()
+
+
+## command line commands
+@click.command("db-upgrade")
+@click.option("--to", "target", type=int, default=LATEST_VERSION, help="Version to upgrade to.")
+@with_appcontext
+def db_upgrade_command(target):
+    for migration in upgrade(target):
+        click.echo("Upgraded to {}: {}".format(migration.version, migration.description))
+    click.echo("Database is at version {}".format(schema_version()))
+
+@click.command("db-downgrade")
+@click.option("--to", "target", type=int, default=None, help="Version to downgrade to, one step down by default.")
+@with_appcontext
+def db_downgrade_command(target):
+    if target is None:
+        target = max(schema_version() - 1, 0)
+    try:
+        for migration in downgrade(target):
+            click.echo("Downgraded from {}: {}".format(migration.version, migration.description))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo("Database is at version {}".format(schema_version()))
@@ -1,18 +1,52 @@
+import re
+import sqlite3
 from datetime import datetime
-from flask import Flask, Response, request
+from flask import Flask, Response, request, current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased, joinedload, selectinload
 
 import click
 from flask.cli import with_appcontext
 
 from budgethub import db
+from budgethub.cache import response_cache
+from budgethub.replica import ReadOnlyConnection
+from budgethub.constants import *
+
+
+##SQLite connections
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Sets the pragmas of SQLITE_PRAGMAS on every new SQLite connection.
+    Foreign keys are always enforced, SQLite leaves them off by default.
+    Connections of the read replica skip the journal mode, it's stored in
+    the database file and set by the primary.
+    """
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    pragmas = {}
+    if has_app_context():
+        pragmas.update(current_app.config.get("SQLITE_PRAGMAS", {}))
+    if isinstance(dbapi_connection, ReadOnlyConnection):
+        pragmas.pop("journal_mode", None)
+    pragmas["foreign_keys"] = "ON"
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
 
 
 ##Association tables
 transaction_category_association_table = db.Table('transaction_category_association_table',
     db.Column('transactionId', db.Integer, db.ForeignKey('transaction.id'), primary_key=True),
-    db.Column('categoryId', db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    db.Column('categoryId', db.Integer, db.ForeignKey('category.id'), primary_key=True),
+    # the primary key only serves lookups starting from the transaction
+    db.Index('ix_transaction_category_categoryId', 'categoryId', 'transactionId')
 )
 
 bankaccount_user_association_table = db.Table('bankaccount_user_association_table',
@@ -29,14 +63,20 @@ Current implementation:
 """
     __tablename__ = 'transaction'
     id = db.Column(db.Integer, primary_key=True)
-    price = db.Column(db.Float, nullable=False)
-    dateTime = db.Column(db.DateTime, nullable=False) 
+    price = db.Column(db.Float, nullable=False, index=True)
+    dateTime = db.Column(db.DateTime, nullable=False, index=True)
     senderId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"))
     receiverId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"))
     sender = db.relationship("User", foreign_keys=[senderId])
     receiver = db.relationship("User", foreign_keys=[receiverId])
     category = db.relationship("Category", secondary=transaction_category_association_table, back_populates="transaction")
 
+    # a user's ledger is read in date order, so the party indexes carry it too
+    __table_args__ = (
+        db.Index('ix_transaction_senderId_dateTime', 'senderId', 'dateTime'),
+        db.Index('ix_transaction_receiverId_dateTime', 'receiverId', 'dateTime'),
+    )
+
 class Category(db.Model):
     __tablename__ = 'category'
     id = db.Column(db.Integer, primary_key=True)
@@ -48,6 +88,8 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(256), nullable=False, unique=True)
     password = db.Column(db.String(64), nullable=False, unique=False)
+    # received minus sent, kept up to date as transactions are added and deleted
+    balance = db.Column(db.Float, nullable=False, default=0, server_default="0")
     bankAccount = db.relationship("BankAccount",secondary=bankaccount_user_association_table, back_populates="user")
 
 class BankAccount(db.Model):
@@ -57,9 +99,610 @@ class BankAccount(db.Model):
     bankName = db.Column(db.String(64), nullable=False, unique=False)
     user = db.relationship("User",secondary=bankaccount_user_association_table, back_populates="bankAccount")
 
+class TableVersion(db.Model):
+    """
+Change counter of a table, bumped in the same database transaction as every
+write to the table. GET handlers build their ETags from these counters, so
+an unchanged resource can be recognized without reading its rows.
+"""
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class SpendingRollup(db.Model):
+    """
+Totals of transactions per month, sender and category, maintained as
+transactions are added and deleted so reports don't have to scan them.
+- rows with a categoryId count a transaction once for each of its categories
+- rows without one count every transaction exactly once, so totals that are
+  not grouped by category aren't inflated by multi-category transactions
+- every group has one row, the rows of a deleted sender are merged into the
+  rows without a sender, see merge_user_rollups
+"""
+    __tablename__ = 'spending_rollup'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.String(7), nullable=False)
+    userId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="SET NULL"))
+    categoryId = db.Column(db.Integer, db.ForeignKey("category.id", ondelete="CASCADE"))
+    total = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_spending_rollup_categoryId', 'categoryId'),
+        db.Index('ix_spending_rollup_userId', 'userId'),
+    )
+
+# NULL never equals NULL in a unique index, so the missing sender and category
+# are indexed as -1 to keep the groups without them unique too
+ROLLUP_GROUP = (
+    SpendingRollup.month,
+    db.func.ifnull(SpendingRollup.userId, -1),
+    db.func.ifnull(SpendingRollup.categoryId, -1)
+)
+db.Index('ix_spending_rollup_group', *ROLLUP_GROUP, unique=True)
+
+
+##Query layer
+# Each endpoint gets its rows through one of these functions. They declare
+# how the relationships the endpoint serializes are loaded, so that a
+# collection GET runs a constant number of queries instead of one per row.
+# Many-to-one relationships are joined, collections are loaded with one
+# extra SELECT ... WHERE id IN (...) per relationship.
+def transaction_query():
+    return Transaction.query.options(
+        joinedload(Transaction.sender),
+        joinedload(Transaction.receiver),
+        selectinload(Transaction.category)
+    )
+
+def filter_transactions(query, date_from=None, date_to=None, min_price=None,
+                        max_price=None, sender=None, receiver=None, category=None):
+    """
+    Narrows a transaction query down. Every filter is written so that SQLite
+    can answer it from an index: parties and categories are resolved to ids
+    in a subquery instead of joining the whole table.
+    """
+
+    if date_from is not None:
+        query = query.filter(Transaction.dateTime >= date_from)
+    if date_to is not None:
+        query = query.filter(Transaction.dateTime <= date_to)
+    if min_price is not None:
+        query = query.filter(Transaction.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Transaction.price <= max_price)
+    if sender is not None:
+        query = query.filter(Transaction.senderId.in_(
+            db.session.query(User.id).filter(User.username == sender)
+        ))
+    if receiver is not None:
+        query = query.filter(Transaction.receiverId.in_(
+            db.session.query(User.id).filter(User.username == receiver)
+        ))
+    if category is not None:
+        table = transaction_category_association_table
+        query = query.filter(Transaction.id.in_(
+            db.session.query(table.c.transactionId)
+            .join(Category, Category.id == table.c.categoryId)
+            .filter(Category.categoryName == category)
+        ))
+    return query
+
+def transactions_in_category(category, query=None):
+    table = transaction_category_association_table
+    return (query or transaction_query()).filter(Transaction.id.in_(
+        db.session.query(table.c.transactionId).filter(table.c.categoryId == category.id)
+    ))
+
+def transactions_by_user(user, query=None):
+    return (query or transaction_query()).filter(db.or_(
+        Transaction.senderId == user.id,
+        Transaction.receiverId == user.id
+    ))
+
+def resolve_names(column, names):
+    """
+    Loads the rows whose unique name column matches one of the names, with
+    one IN query instead of one query per name. Handlers use this to turn
+    the names in a request body into instances and to report every name that
+    doesn't exist at once.
+
+    : param column: unique name column of a model, e.g. Category.categoryName
+    : param names: iterable of names, duplicates are ignored
+    : return: tuple of (dict from name to instance in the order of the names,
+    list of the names that were not found). Values that aren't strings are
+    never found and are returned as they are.
+    """
+
+    names = list(names)
+    strings = list(dict.fromkeys(name for name in names if isinstance(name, str)))
+    found = {}
+    for start in range(0, len(strings), IN_CLAUSE_BATCH):
+        batch = strings[start:start + IN_CLAUSE_BATCH]
+        for instance in column.class_.query.filter(column.in_(batch)):
+            found[getattr(instance, column.key)] = instance
+    resolved = {name: found[name] for name in strings if name in found}
+    missing = [name for name in strings if name not in found]
+    return resolved, missing + [name for name in names if not isinstance(name, str)]
+
+def replace_related(collection, instances):
+    """
+    Makes a many-to-many relationship collection hold exactly the given
+    instances. Only the instances that are added or removed are touched, so
+    only their association rows are written.
+    """
+
+    instances = list(instances)
+    current = list(collection)
+    for instance in current:
+        if instance not in instances:
+            collection.remove(instance)
+    for instance in instances:
+        if instance not in current:
+            collection.append(instance)
+
+def user_query():
+    return User.query.options(
+        selectinload(User.bankAccount)
+    )
+
+def bank_account_query():
+    return BankAccount.query.options(
+        selectinload(BankAccount.user)
+    )
+
+
+##Row queries
+# The collection GETs don't need ORM instances at all. These return plain
+# row tuples for the same rows as the queries above, with only the columns
+# of the requested item fields. The related values are looked up separately
+# with one IN query per page of keys, and only when they are requested.
+def transaction_rows(fields=TRANSACTION_FIELDS):
+    """
+    : param fields: item fields the rows are for, the id is always selected.
+    The users are only joined when sender or receiver is asked for.
+    """
+
+    columns = [Transaction.id]
+    if "price" in fields:
+        columns.append(Transaction.price)
+    if "dateTime" in fields:
+        columns.append(Transaction.dateTime)
+    joins = []
+    for name, column in (("sender", Transaction.senderId), ("receiver", Transaction.receiverId)):
+        if name in fields:
+            party = aliased(User)
+            columns.append(party.username.label(name))
+            joins.append((party, column == party.id))
+    query = db.session.query(*columns)
+    for party, onclause in joins:
+        query = query.outerjoin(party, onclause)
+    return query
+
+def user_rows(fields=USER_FIELDS):
+    columns = [User.id, User.username]
+    if "balance" in fields:
+        columns.append(User.balance)
+    return db.session.query(*columns)
+
+def category_rows(fields=CATEGORY_FIELDS):
+    """
+    : param fields: item fields the rows are for. The transactions are only
+    counted when transaction_count is asked for, all categories with one
+    grouped COUNT over the association table's index.
+    """
+
+    columns = [Category.id, Category.categoryName.label("category_name")]
+    if "transaction_count" not in fields:
+        return db.session.query(*columns).order_by(Category.id)
+    table = transaction_category_association_table
+    counts = db.select([table.c.categoryId, db.func.count().label("count")]) \
+        .group_by(table.c.categoryId).alias("counts")
+    columns.append(db.func.coalesce(counts.c.count, 0).label("transaction_count"))
+    return db.session.query(*columns).outerjoin(counts, counts.c.categoryId == Category.id) \
+        .order_by(Category.id)
+
+def bank_account_rows(fields=BANK_ACCOUNT_FIELDS):
+    columns = [BankAccount.id, BankAccount.iban]
+    if "bankName" in fields:
+        columns.append(BankAccount.bankName)
+    return db.session.query(*columns)
+
+def group_related(statement, key_column, keys, **params):
+    """
+    Runs a select of (key, value) pairs for the given keys and groups the
+    values by key, keeping the order of the select. The IN clause is bound
+    as one expanding parameter, so the statement is built only once, and the
+    keys are split into batches only when there are more of them than SQLite
+    accepts parameters.
+
+    : param key_column: column the keys are matched against, None if the
+    statement already has an IN clause with the "keys" parameter
+    : param params: values of the other parameters of the statement
+    : return: dict from key to list of values, keys without values are missing
+    """
+
+    if key_column is not None:
+        statement = statement.where(key_column.in_(db.bindparam("keys", expanding=True)))
+    keys = list(keys)
+    grouped = {}
+    for start in range(0, len(keys), IN_CLAUSE_BATCH):
+        batch = keys[start:start + IN_CLAUSE_BATCH]
+        for key, value in db.session.execute(statement, dict(params, keys=batch)).fetchall():
+            grouped.setdefault(key, []).append(value)
+    return grouped
+
+def categories_of_transactions(ids):
+    table = transaction_category_association_table
+    category = Category.__table__
+    statement = db.select([table.c.transactionId, category.c.categoryName]).select_from(
+        table.join(category, category.c.id == table.c.categoryId)
+    ).order_by(table.c.transactionId, category.c.id)
+    return group_related(statement, table.c.transactionId, ids)
+
+def transaction_previews_of_categories(ids, limit):
+    """
+    Returns the ids of the first limit transactions of each category, in id
+    order like the full lists used to be. The id of each category's last
+    previewed transaction is looked up first, then the association table's
+    categoryId index is read only up to it, so a preview costs limit rows
+    however many transactions the category has. CROSS JOIN keeps SQLite from
+    reading the association table first.
+    """
+
+    statement = db.text(
+        'SELECT a."categoryId", a."transactionId" FROM ('
+        '  SELECT category.id AS id, coalesce(('
+        '    SELECT "transactionId" FROM transaction_category_association_table'
+        '    WHERE "categoryId" = category.id ORDER BY "transactionId" LIMIT 1 OFFSET :offset'
+        '  ), 9223372036854775807) AS last FROM category WHERE category.id IN :keys'
+        ') AS previews CROSS JOIN transaction_category_association_table AS a '
+        'WHERE a."categoryId" = previews.id AND a."transactionId" <= previews.last '
+        'ORDER BY a."categoryId", a."transactionId"'
+    ).bindparams(db.bindparam("keys", expanding=True))
+    return group_related(statement, None, ids, offset=limit - 1)
+
+def transaction_count_of_category(category):
+    table = transaction_category_association_table
+    return db.session.query(db.func.count()).select_from(table) \
+        .filter(table.c.categoryId == category.id).scalar()
+
+def bank_accounts_of_users(ids):
+    table = bankaccount_user_association_table
+    account = BankAccount.__table__
+    statement = db.select([table.c.userId, account.c.iban]).select_from(
+        table.join(account, account.c.id == table.c.bankAccountId)
+    ).order_by(table.c.userId, account.c.id)
+    return group_related(statement, table.c.userId, ids)
+
+def users_of_bank_accounts(ids):
+    table = bankaccount_user_association_table
+    user = User.__table__
+    statement = db.select([table.c.bankAccountId, user.c.username]).select_from(
+        table.join(user, user.c.id == table.c.userId)
+    ).order_by(table.c.bankAccountId, user.c.id)
+    return group_related(statement, table.c.bankAccountId, ids)
+
+
+##Search index
+# Users, categories and bank accounts are indexed for prefix search in one
+# FTS5 table. Triggers keep it in sync with every write to the indexed
+# tables, the API's as well as anything else that writes to the database.
+# The rowid of an entry is the id of its row times 4 plus the code of its
+# kind, so a trigger finds the entry of a row without a scan.
+SEARCH_SOURCES = [
+    #kind, code, table, name column, indexed text
+    ("user", 1, "user", "username", '{row}.username'),
+    ("category", 2, "category", "categoryName", '{row}."categoryName"'),
+    ("bankaccount", 3, "bankAccount", "iban", '{row}.iban || \' \' || {row}."bankName"'),
+]
+
+def search_index_ddl():
+    """
+    Returns the statements that create the search index and its triggers.
+    Every statement can be run again on a database that already has them.
+    """
+
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "kind UNINDEXED, name UNINDEXED, body, prefix='1 2 3', "
+        "tokenize='unicode61 remove_diacritics 2')"
+    ]
+    for kind, code, table, name, text in SEARCH_SOURCES:
+        columns = [name] + re.findall(r'\{row\}\."?(\w+)', text)
+        insert = (
+            "INSERT INTO search_index(rowid, kind, name, body) "
+            "VALUES (new.id * 4 + {code}, '{kind}', new.\"{name}\", {text});"
+        ).format(code=code, kind=kind, name=name, text=text.format(row="new"))
+        delete = "DELETE FROM search_index WHERE rowid = old.id * 4 + {};".format(code)
+        statements += [
+            'CREATE TRIGGER IF NOT EXISTS search_{0}_insert AFTER INSERT ON "{1}" '
+            "BEGIN {2} END".format(kind, table, insert),
+            'CREATE TRIGGER IF NOT EXISTS search_{0}_update AFTER UPDATE OF {1} ON "{2}" '
+            "BEGIN {3} {4} END".format(
+                kind, ", ".join('"{}"'.format(column) for column in dict.fromkeys(columns)),
+                table, delete, insert
+            ),
+            'CREATE TRIGGER IF NOT EXISTS search_{0}_delete AFTER DELETE ON "{1}" '
+            "BEGIN {2} END".format(kind, table, delete),
+        ]
+    return statements
+
+def index_search_rows(kind, first, last):
+    """
+    Adds the rows of one kind with ids from first to last to the search
+    index, for filling the index of an existing database.
+    """
+
+    for source_kind, code, table, name, text in SEARCH_SOURCES:
+        if source_kind == kind:
+            db.session.execute(
+                "INSERT OR REPLACE INTO search_index(rowid, kind, name, body) "
+                'SELECT id * 4 + {code}, \'{kind}\', "{name}", {text} FROM "{table}" '
+                "WHERE id BETWEEN :first AND :last".format(
+                    code=code, kind=kind, name=name, text=text.format(row='"{}"'.format(table)), table=table
+                ),
+                {"first": first, "last": last}
+            )
+
+def search(terms, kinds=None, limit=10):
+    """
+    Finds the users, categories and bank accounts with words that start with
+    every one of the terms, shortest first. Ranking every match of a short
+    prefix would take as long as there are matches, so only the first
+    SEARCH_CANDIDATES matches are ranked.
+
+    : param terms: list of words, as split by split_search_terms
+    : param kinds: kinds of entries to return, all of them if None
+    : return: list of (kind, name) tuples
+    """
+
+    match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in terms)
+    candidates = "SELECT kind, name, body FROM search_index WHERE search_index MATCH :match"
+    params = {"match": match, "limit": limit, "candidates": SEARCH_CANDIDATES}
+    if kinds:
+        candidates += " AND kind IN ({})".format(", ".join(":kind{}".format(i) for i in range(len(kinds))))
+        params.update(("kind{}".format(i), kind) for i, kind in enumerate(kinds))
+    statement = (
+        "SELECT kind, name FROM ({} LIMIT :candidates) "
+        "ORDER BY length(body), name LIMIT :limit".format(candidates)
+    )
+    return db.session.execute(statement, params).fetchall()
+
+def split_search_terms(query):
+    #the words the index was built from are split the same way
+    return re.findall(r"\w+", query.lower())
+
+for _statement in search_index_ddl():
+    event.listen(db.metadata, "after_create", db.DDL(_statement).execute_if(dialect="sqlite"))
+event.listen(db.metadata, "before_drop", db.DDL("DROP TABLE IF EXISTS search_index").execute_if(dialect="sqlite"))
+
+
+##Table versions
+def bump_table_versions(*models):
+    """
+    Increments the change counters of the tables of the given models. Must be
+    called in the same database transaction as the write it announces. Cached
+    responses built from these tables are dropped at the same time.
+    """
+
+    names = [model.__tablename__ for model in models]
+    table = TableVersion.__table__
+    db.session.execute(
+        table.insert().prefix_with("OR IGNORE"),
+        [{"name": name, "version": 0} for name in names]
+    )
+    TableVersion.query.filter(TableVersion.name.in_(names)).update(
+        {TableVersion.version: TableVersion.version + 1}, synchronize_session=False
+    )
+    response_cache.invalidate(names)
+
+def table_versions(*models):
+    """
+    Reads the change counters of the tables of the given models in one query.
+
+    : return: dict from table name to version, 0 for tables never written
+    """
+
+    names = [model.__tablename__ for model in models]
+    versions = dict.fromkeys(names, 0)
+    versions.update(db.session.query(TableVersion.name, TableVersion.version)
+                    .filter(TableVersion.name.in_(names)))
+    return versions
+
+
+##Rollups
+def update_rollups(entries, sign=1):
+    """
+    Adds transactions to (sign=1) or removes them from (sign=-1) the spending
+    rollup. The changes are summed per group first, so a batch touches every
+    group once. Must be called in the same database transaction as the
+    insert or delete it mirrors.
+
+    : param entries: iterable of (price, dateTime, senderId, category ids)
+    : param int sign: 1 for added transactions, -1 for deleted ones
+    """
+
+    deltas = {}
+    for price, date_time, sender_id, category_ids in entries:
+        month = date_time.strftime("%Y-%m")
+        for category_id in [None] + list(category_ids):
+            total, count = deltas.get((month, sender_id, category_id), (0, 0))
+            deltas[(month, sender_id, category_id)] = (total + sign * price, count + sign)
+
+    for (month, user_id, category_id), (total, count) in deltas.items():
+        key = (month, -1 if user_id is None else user_id, -1 if category_id is None else category_id)
+        row_id = db.session.query(SpendingRollup.id).filter(
+            *[column == value for column, value in zip(ROLLUP_GROUP, key)]
+        ).scalar()
+        if row_id is None:
+            db.session.add(SpendingRollup(
+                month=month, userId=user_id, categoryId=category_id,
+                total=total, count=count
+            ))
+            continue
+        rows = SpendingRollup.query.filter_by(id=row_id)
+        rows.update({
+            SpendingRollup.total: SpendingRollup.total + total,
+            SpendingRollup.count: SpendingRollup.count + count
+        }, synchronize_session=False)
+        if sign < 0:
+            # a group left with a total but no transactions has drifted, it's
+            # kept so the drift shows up instead of vanishing
+            rows.filter(
+                SpendingRollup.count <= 0, db.func.abs(SpendingRollup.total) < 1e-6
+            ).delete(synchronize_session=False)
+
+def merge_user_rollups(user_id):
+    """
+    Moves the rollup rows of a user that is about to be deleted to the groups
+    without a sender, adding them to the rows that are already there. Must
+    be called in the same database transaction as the delete, before it.
+    """
+
+    rows = SpendingRollup.query.filter_by(userId=user_id).all()
+    if not rows:
+        return
+    orphans = {
+        (row.month, row.categoryId): row
+        for row in SpendingRollup.query.filter(
+            SpendingRollup.userId.is_(None),
+            SpendingRollup.month.in_({row.month for row in rows})
+        )
+    }
+    for row in rows:
+        orphan = orphans.get((row.month, row.categoryId))
+        if orphan is None:
+            row.userId = None
+        else:
+            orphan.total += row.total
+            orphan.count += row.count
+            db.session.delete(row)
+    bump_table_versions(SpendingRollup)
+
+##Balances
+def update_balances(entries, sign=1):
+    """
+    Moves the amounts of added (sign=1) or deleted (sign=-1) transactions
+    between the balances of their senders and receivers. Every user's
+    balance is changed with one atomic UPDATE no matter how many of the
+    transactions they are part of. Must be called in the same database
+    transaction as the insert or delete it mirrors.
+
+    : param entries: iterable of (price, senderId, receiverId)
+    : param int sign: 1 for added transactions, -1 for deleted ones
+    """
+
+    deltas = {}
+    for price, sender_id, receiver_id in entries:
+        if sender_id is not None:
+            deltas[sender_id] = deltas.get(sender_id, 0) - sign * price
+        if receiver_id is not None:
+            deltas[receiver_id] = deltas.get(receiver_id, 0) + sign * price
+
+    for user_id, delta in deltas.items():
+        if delta:
+            User.query.filter_by(id=user_id).update(
+                {User.balance: User.balance + delta}, synchronize_session=False
+            )
+
+def computed_balances():
+    """
+    Computes every user's balance from scratch from the transactions.
+
+    : return: dict from user id to balance
+    """
+
+    balances = {user_id: 0 for user_id, in db.session.query(User.id)}
+    received = db.session.query(Transaction.receiverId, db.func.sum(Transaction.price)) \
+        .filter(Transaction.receiverId.isnot(None)).group_by(Transaction.receiverId)
+    sent = db.session.query(Transaction.senderId, db.func.sum(Transaction.price)) \
+        .filter(Transaction.senderId.isnot(None)).group_by(Transaction.senderId)
+    for user_id, total in received:
+        if user_id in balances:
+            balances[user_id] += total
+    for user_id, total in sent:
+        if user_id in balances:
+            balances[user_id] -= total
+    return balances
+
+def rebuild_rollups(date_from=None, date_to=None):
+    """
+    Recomputes the spending rollup from the transactions with two
+    INSERT ... SELECT ... GROUP BY statements. Without dates the whole rollup
+    is rebuilt.
+
+    : param datetime date_from: first day of the first month to rebuild
+    : param datetime date_to: first day of the month after the last one
+    """
+
+    table = SpendingRollup.__table__
+    month = db.func.strftime("%Y-%m", Transaction.dateTime)
+    association = transaction_category_association_table
+    rollups = SpendingRollup.query
+    transactions = []
+    if date_from is not None:
+        rollups = rollups.filter(SpendingRollup.month >= date_from.strftime("%Y-%m"))
+        transactions.append(Transaction.dateTime >= date_from)
+    if date_to is not None:
+        rollups = rollups.filter(SpendingRollup.month < date_to.strftime("%Y-%m"))
+        transactions.append(Transaction.dateTime < date_to)
+    rollups.delete(synchronize_session=False)
+    db.session.execute(table.insert().from_select(
+        ["month", "userId", "categoryId", "total", "count"],
+        db.select([
+            month, Transaction.senderId, db.null(),
+            db.func.sum(Transaction.price), db.func.count()
+        ]).where(db.and_(*transactions)).group_by(month, Transaction.senderId)
+    ))
+    db.session.execute(table.insert().from_select(
+        ["month", "userId", "categoryId", "total", "count"],
+        db.select([
+            month, Transaction.senderId, association.c.categoryId,
+            db.func.sum(Transaction.price), db.func.count()
+        ]).select_from(
+            Transaction.__table__.join(association, association.c.transactionId == Transaction.id)
+        ).where(db.and_(*transactions)).group_by(month, Transaction.senderId, association.c.categoryId)
+    ))
+
 
 ## command line commands
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
-    db.create_all()
\ No newline at end of file
+    db.create_all()
+    # a new database already has the latest schema, see migrations.py
+    db.session.execute("PRAGMA user_version={:d}".format(SCHEMA_VERSION))
+    db.session.commit()
+
+@click.command("verify-balances")
+@click.option("--fix", is_flag=True, help="Overwrite drifted balances with the recomputed ones.")
+@with_appcontext
+def verify_balances_command(fix):
+    drifted = 0
+    balances = computed_balances()
+    for user in User.query.order_by(User.id):
+        expected = balances[user.id]
+        if abs(user.balance - expected) > 1e-6 * max(1, abs(expected)):
+            drifted += 1
+            click.echo("{}: stored {} but transactions give {}".format(
+                user.username, user.balance, expected
+            ))
+            if fix:
+                user.balance = expected
+    if fix and drifted:
+        bump_table_versions(User)
+    db.session.commit()
+    click.echo("{} of {} balances drifted{}".format(
+        drifted, len(balances), ", fixed" if fix and drifted else ""
+    ))
+    if drifted and not fix:
+        raise SystemExit(1)
+
+@click.command("rebuild-rollups")
+@with_appcontext
+def rebuild_rollups_command():
+    rebuild_rollups()
+    bump_table_versions(SpendingRollup)
+    db.session.commit()
+    click.echo("Rebuilt {} rollup rows".format(SpendingRollup.query.count()))
\ No newline at end of file
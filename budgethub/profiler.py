@@ -0,0 +1,222 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESOURCES_DIR = os.path.join(PACKAGE_DIR, "resources")
+
+# IN lists of different lengths are still the same statement
+IN_LIST = re.compile(r"\(\?(?:, \?)*\)")
+
+
+# the start time is kept on the execution context, which is dropped with it
+# when a statement fails
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and "sql_profile" in g:
+        context.profiler_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "profiler_started", None)
+    if started is None or not has_request_context() or "sql_profile" not in g:
+        return
+    profiler.record(conn, statement, parameters, executemany, time.perf_counter() - started)
+
+
+def call_site():
+    """
+    Returns the line of budgethub/resources/*.py that ran the current
+    statement, e.g. resources/user.py:42 in get. Statements run outside the
+    resources get the innermost line of the package instead.
+    """
+
+    frame = sys._getframe(1)
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PACKAGE_DIR) and filename != __file__:
+            site = "{}:{} in {}".format(
+                os.path.relpath(filename, PACKAGE_DIR), frame.f_lineno, frame.f_code.co_name
+            )
+            if filename.startswith(RESOURCES_DIR):
+                return site
+            fallback = fallback or site
+        frame = frame.f_back
+    return fallback or "-"
+
+def summarize(statements, threshold):
+    """
+    Sums up the statements of one request. Statements that only differ in
+    their parameters and were run threshold times or more are reported as
+    repeated, the usual sign of a lazy load in a loop (N+1 queries).
+
+    : param statements: dicts with statement, parameters, duration and site
+    : return: dict with the number of queries, their total time in
+    milliseconds, the number of slow ones and the repeated statements
+    """
+
+    groups = {}
+    for entry in statements:
+        groups.setdefault(IN_LIST.sub("(?)", entry["statement"]), []).append(entry)
+    repeated = []
+    for statement, entries in groups.items():
+        if len(entries) >= threshold and len({repr(entry["parameters"]) for entry in entries}) > 1:
+            repeated.append({
+                "statement": statement,
+                "count": len(entries),
+                "site": entries[0]["site"]
+            })
+    repeated.sort(key=lambda entry: -entry["count"])
+    return {
+        "queries": len(statements),
+        "time_ms": sum(entry["duration"] for entry in statements) * 1000,
+        "slow": sum(1 for entry in statements if entry["slow"]),
+        "repeated": repeated
+    }
+
+
+class SQLProfiler(object):
+    """
+    Records every SQL statement of a request with its duration and the line
+    of the resource that ran it when SQL_PROFILER_ENABLED is set. The
+    summary of the request is sent in the X-SQL-Profile header, and
+    repeated statements are also written to the app log. Statements slower
+    than SQL_PROFILER_SLOW_MS are written with their EXPLAIN QUERY PLAN to
+    SQL_PROFILER_LOG, a log file rotated at SQL_PROFILER_LOG_BYTES. Finding
+    the call site walks the stack for every statement, so the profiler is
+    meant for development and load tests, not for production. The header of
+    a streamed response only counts the statements run before its body.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("budgethub.slow_queries")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQL_PROFILER_ENABLED", False)
+        app.config.setdefault("SQL_PROFILER_SLOW_MS", 100)
+        app.config.setdefault("SQL_PROFILER_REPEAT_THRESHOLD", 3)
+        app.config.setdefault("SQL_PROFILER_LOG", os.path.join(app.instance_path, "slow_queries.log"))
+        app.config.setdefault("SQL_PROFILER_LOG_BYTES", 1024 * 1024)
+        app.config.setdefault("SQL_PROFILER_LOG_BACKUPS", 5)
+        app.before_request(self.start_request)
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def start_request():
+        if current_app.config["SQL_PROFILER_ENABLED"]:
+            g.sql_profile = []
+
+    def record(self, conn, statement, parameters, executemany, duration):
+        config = current_app.config
+        slow = duration * 1000 >= config["SQL_PROFILER_SLOW_MS"]
+        site = call_site()
+        g.sql_profile.append({
+            "statement": statement,
+            "parameters": parameters,
+            "duration": duration,
+            "site": site,
+            "slow": slow
+        })
+        if slow:
+            plan = None if executemany else self.explain(conn, statement, parameters)
+            self.log_slow_query(config, statement, parameters, duration, site, plan)
+
+    @staticmethod
+    def explain(conn, statement, parameters):
+        """
+        Returns the lines of the SQLite query plan of the statement, or None
+        for other databases. A cursor of its own is used so the results of
+        the profiled statement are left alone.
+        """
+
+        if conn.dialect.name != "sqlite":
+            return None
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            # rows are (id, parent id, unused, detail), children indented
+            depths = {0: 0}
+            lines = []
+            for row_id, parent, unused, detail in cursor.fetchall():
+                depths[row_id] = depths.get(parent, 0) + 1
+                lines.append("  " * (depths[row_id] - 1) + detail)
+            return lines
+        except Exception as e:
+            return ["could not explain: {}".format(e)]
+        finally:
+            cursor.close()
+
+    def log_slow_query(self, config, statement, parameters, duration, site, plan):
+        path = config["SQL_PROFILER_LOG"]
+        with self.lock:
+            if self.handler is None or self.handler.baseFilename != os.path.abspath(path):
+                if self.handler is not None:
+                    self.logger.removeHandler(self.handler)
+                    self.handler.close()
+                self.handler = RotatingFileHandler(
+                    path, maxBytes=config["SQL_PROFILER_LOG_BYTES"],
+                    backupCount=config["SQL_PROFILER_LOG_BACKUPS"]
+                )
+                self.handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                self.logger.addHandler(self.handler)
+        lines = [
+            "{:.1f} ms {} {} at {}".format(duration * 1000, request.method, request.full_path, site),
+            "    " + " ".join(statement.split()),
+            "    parameters: {}".format(repr(parameters)[:500])
+        ]
+        lines += ["    plan: " + line for line in plan or []]
+        self.logger.info("\n".join(lines))
+
+    def after_request(self, response):
+        state = g._get_current_object()
+        statements = state.get("sql_profile")
+        if statements is None:
+            return response
+        threshold = current_app.config["SQL_PROFILER_REPEAT_THRESHOLD"]
+        summary = summarize(statements, threshold)
+        header = "queries={}; time_ms={:.2f}; slow={}".format(
+            summary["queries"], summary["time_ms"], summary["slow"]
+        )
+        if summary["repeated"]:
+            header += "; repeated=" + ", ".join(
+                "{} x{}".format(entry["site"], entry["count"]) for entry in summary["repeated"]
+            )
+        response.headers["X-SQL-Profile"] = header
+
+        target = "{} {}".format(request.method, request.full_path)
+        if response.is_streamed:
+            # the header is sent before the body, so it only counts the
+            # statements run so far; the rest are still recorded while the
+            # body is sent and the repeated ones logged when it's closed
+            logger = current_app.logger
+            def close():
+                state.pop("sql_profile", None)
+                self.log_repeated(logger, target, summarize(statements, threshold)["repeated"])
+            response.call_on_close(close)
+        else:
+            state.pop("sql_profile")
+            self.log_repeated(current_app.logger, target, summary["repeated"])
+        return response
+
+    @staticmethod
+    def log_repeated(logger, target, repeated):
+        for entry in repeated:
+            logger.warning("%s ran %d times at %s: %s", target, entry["count"], entry["site"],
+                           " ".join(entry["statement"].split()))
+
+profiler = SQLProfiler()
@@ -0,0 +1,139 @@
+import sqlite3
+import threading
+from urllib.parse import quote
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import UpdateBase
+
+
+class ReadOnlyConnection(sqlite3.Connection):
+    """
+    SQLite connection of the read replica. The class only marks the
+    connection, so models.set_sqlite_pragmas knows not to set pragmas that
+    would write to the database file.
+    """
+
+
+class ReadReplica(object):
+    """
+    Read-only engine that the GET and HEAD requests are served from. The
+    replica is READ_REPLICA_URI if it's set, for example a copy of the
+    database kept up to date by a replication tool. Otherwise a SQLite
+    database file is opened a second time in read-only mode (mode=ro), so
+    reads get their own connection pool next to the single writer. Other
+    databases have no replica and everything runs on the primary engine.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.engines = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("READ_REPLICA_ENABLED", True)
+        app.config.setdefault("READ_REPLICA_URI", None)
+        app.before_request(self.start_request)
+
+    @staticmethod
+    def uri(app):
+        """
+        Returns the URI of the replica of the app, or None if the app
+        reads from the primary.
+        """
+
+        if not app.config["READ_REPLICA_ENABLED"]:
+            return None
+        if app.config["READ_REPLICA_URI"]:
+            return app.config["READ_REPLICA_URI"]
+        url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+        if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+            return None
+        return "sqlite:///file:{}?mode=ro&uri=true".format(quote(url.database))
+
+    def get_engine(self, app):
+        """
+        Returns the replica engine of the app, created on first use with the
+        engine options of the primary. None if the app has no replica.
+        """
+
+        uri = self.uri(app)
+        if uri is None:
+            return None
+        with self.lock:
+            engine = self.engines.get(uri)
+            if engine is None:
+                options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+                if uri.startswith("sqlite"):
+                    options["connect_args"] = dict(
+                        options.get("connect_args", {}), factory=ReadOnlyConnection
+                    )
+                engine = self.engines[uri] = create_engine(uri, **options)
+        return engine
+
+    def dispose(self):
+        """
+        Closes the pooled connections of every replica engine and forgets
+        the engines.
+        """
+
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines.clear()
+
+    @staticmethod
+    def start_request():
+        # the session outlives the request when an app context was pushed
+        # outside of it, e.g. in the tests
+        session = current_app.extensions["sqlalchemy"].db.session
+        if session.registry.has():
+            session.info.pop("wrote", None)
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that runs the queries of GET and HEAD requests on the read
+    replica and everything else on the primary. A request that has written
+    anything stays on the primary until it ends, so it always reads its own
+    writes even if the replica lags behind.
+    """
+
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        event.listen(self, "before_flush", self._mark_written)
+
+    @staticmethod
+    def _mark_written(session, flush_context, instances):
+        session.info["wrote"] = True
+
+    def reads_from_replica(self):
+        return (
+            has_request_context()
+            and request.method in ("GET", "HEAD")
+            and not self.info.get("wrote")
+        )
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+        elif self.reads_from_replica():
+            engine = read_replica.get_engine(self.app)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with the sessions created as RoutingSession.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+read_replica = ReadReplica()
@@ -3,7 +3,7 @@ from flask_restful import Resource
 from flask import Flask, Response, request, url_for
 from werkzeug.exceptions import BadRequest
 from sqlalchemy.exc import IntegrityError
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from budgethub import db
 from budgethub.models import *
 from budgethub.constants import *
@@ -11,6 +11,7 @@ from budgethub.utils import *
 
 #Bank account resources
 class BankAccountCollection(Resource):
+    @conditional_get(BankAccount, User)
     def get(self):
         body = BankAccountBuilder()
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
@@ -20,20 +21,14 @@ class BankAccountCollection(Resource):
         body.add_control_all_transactions()
         body.add_control_all_users()
 
-        banks = []
-        for bank in BankAccount.query.all():
-            bank_item_body = BankAccountBuilder(
-                iban = bank.iban,
-                bankName = bank.bankName,
-                user = [user.username for user in bank.user]
-
-            )
-            bank_item_body.add_control("self", url_for("api.bankaccountitem", iban=bank.iban))
-            bank_item_body.add_control("profile", BANK_ACCOUNT_PROFILE)
-            banks.append(bank_item_body)
-        body["items"] = banks
+        try:
+            fields = parse_fields(request.args, BANK_ACCOUNT_FIELDS)
+            controls = parse_controls(request.args)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        body["items"] = bank_account_items(bank_account_rows(fields), fields, controls)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def post(self):
         if not request.json:
@@ -43,7 +38,7 @@ class BankAccountCollection(Resource):
             )
 
         try:
-            validate(request.json, BankAccountBuilder.bank_account_schema())
+            schema_registry.validate("bank-account", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -55,6 +50,7 @@ class BankAccountCollection(Resource):
 
         try:
             db.session.add(bank)
+            bump_table_versions(BankAccount)
             db.session.commit()
         except IntegrityError:
             return create_error_response(
@@ -67,8 +63,9 @@ class BankAccountCollection(Resource):
         })
 
 class BankAccountItem(Resource):
+    @conditional_get(BankAccount, User)
     def get(self, iban):
-        db_bank = BankAccount.query.filter_by(iban=iban).first()
+        db_bank = bank_account_query().filter_by(iban=iban).first()
         if db_bank is None:
             return create_error_response(
                 404, "Not found",
@@ -87,7 +84,7 @@ class BankAccountItem(Resource):
         body.add_control_delete_bank_account(iban)
         body.add_control_edit_bank_account(iban)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def put(self, iban):
         db_bank = BankAccount.query.filter_by(iban=iban).first()
@@ -104,7 +101,7 @@ class BankAccountItem(Resource):
             )
 
         try:
-            validate(request.json, BankAccountBuilder.bank_account_schema())
+            schema_registry.validate("bank-account", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         """
@@ -121,6 +118,7 @@ class BankAccountItem(Resource):
         db_bank.bankName = request.json["bankName"]
 
         try:
+            bump_table_versions(BankAccount)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -140,6 +138,7 @@ class BankAccountItem(Resource):
             )
 
         db.session.delete(db_bank)
+        bump_table_versions(BankAccount)
         db.session.commit()
 
         return Response(status=204)
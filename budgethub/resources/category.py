@@ -1,4 +1,4 @@
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 
 from flask_restful import Resource
 from flask import Flask, Response, request, url_for
@@ -13,6 +13,7 @@ from budgethub.utils import *
 
 # Category resources
 class CategoryCollection(Resource):
+    @conditional_get(Category, Transaction)
     def get(self):
         body = CategoryBuilder()
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
@@ -22,26 +23,22 @@ class CategoryCollection(Resource):
         body.add_control_all_transactions()
         body.add_control_all_users()
 
-        categories = []
-        for category in Category.query.all():
-            category_body = CategoryBuilder(
-                category_name=category.categoryName,
-                transaction=[transaction.id for transaction in category.transaction]
-            )
-            category_body.add_control("self", url_for(
-                "api.categoryitem", category_name=category.categoryName))
-            category_body.add_control("profile", CATEGORY_PROFILE)
-            categories.append(category_body)
-        body["items"] = categories
+        try:
+            fields = parse_fields(request.args, CATEGORY_FIELDS)
+            controls = parse_controls(request.args)
+            embed_limit = parse_embed(request.args)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        body["items"] = category_items(category_rows(fields), fields, controls, embed_limit)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def post(self):
         if not request.json:
             return create_error_response(
                 415, "Unsupported media type", "Requests must be JSON")
         try:
-            validate(request.json, CategoryBuilder.category_schema())
+            schema_registry.validate("category", request.json)
         except ValidationError:
             return create_error_response(
                 400, "Invalid JSON document", str(ValidationError)
@@ -53,6 +50,7 @@ class CategoryCollection(Resource):
 
         try:
             db.session.add(category)
+            bump_table_versions(Category)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -69,6 +67,7 @@ class CategoryCollection(Resource):
 
 
 class CategoryItem(Resource):
+    @conditional_get(Category, Transaction)
     def get(self, category_name):
         db_category = Category.query.filter_by(categoryName=category_name).first()
         if db_category is None:
@@ -77,9 +76,18 @@ class CategoryItem(Resource):
                 "No category was foung with a name {}.".format(category_name)
             )
 
+        try:
+            embed_limit = parse_embed(request.args)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = CategoryBuilder(
-            category_name=db_category.categoryName
+            category_name=db_category.categoryName,
+            transaction_count=transaction_count_of_category(db_category)
         )
+        if embed_limit is not None:
+            body["transaction"] = transaction_previews_of_categories(
+                [db_category.id], embed_limit).get(db_category.id, [])
 
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
         body.add_control(
@@ -87,10 +95,11 @@ class CategoryItem(Resource):
         body.add_control("profile", CATEGORY_PROFILE)
         body.add_control(
             "bumeta:categories-all", url_for("api.categorycollection"))
+        body.add_control_transactions_in(category_name)
         body.add_control_delete_category(category_name)
         body.add_control_edit_category(category_name)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def put(self, category_name):
         db_category = Category.query.filter_by(categoryName=category_name).first()
@@ -100,7 +109,7 @@ class CategoryItem(Resource):
             )
 
         try:
-            validate(request.json, CategoryBuilder.category_schema())
+            schema_registry.validate("category", request.json)
         except ValidationError:
             return create_error_response(
                 400, "Invalid JSON document", str(ValidationError))
@@ -108,6 +117,7 @@ class CategoryItem(Resource):
         db_category.categoryName = request.json["category_name"]
 
         try:
+            bump_table_versions(Category)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -127,6 +137,7 @@ class CategoryItem(Resource):
             )
 
         db.session.delete(db_category)
+        bump_table_versions(Category)
         db.session.commit()
 
         return Response(status=204)
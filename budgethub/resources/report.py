@@ -0,0 +1,96 @@
+import re
+
+from flask_restful import Resource
+
+from flask import Flask, Response, request, url_for
+
+from budgethub import db
+from budgethub.models import *
+from budgethub.constants import *
+from budgethub.utils import *
+
+#Keys a report can be grouped by
+GROUP_KEYS = ("category", "user", "month")
+MONTH_PATTERN = re.compile(r"^[0-9]{4}-[01][0-9]$")
+
+
+def _parse_group_by(args):
+    group_by = [key for key in args.get("group_by", "").split(",") if key]
+    for key in group_by:
+        if key not in GROUP_KEYS:
+            raise ValueError("Reports can only be grouped by {}".format(", ".join(GROUP_KEYS)))
+    return list(dict.fromkeys(group_by))
+
+def _parse_month(args, name):
+    value = args.get(name)
+    if value is not None and not MONTH_PATTERN.match(value):
+        raise ValueError("'{}' must be a month in the format YYYY-MM".format(name))
+    return value
+
+
+#Report resources
+class ReportTotals(Resource):
+    """
+    Spending totals grouped by any combination of category, user (the
+    sender) and month. The totals are summed from the spending rollup, so a
+    report costs time proportional to the number of groups rather than the
+    number of transactions.
+    """
+
+    @conditional_get(SpendingRollup, Transaction, User, Category)
+    def get(self):
+        try:
+            group_by = _parse_group_by(request.args)
+            month_from = _parse_month(request.args, "from")
+            month_to = _parse_month(request.args, "to")
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        query = db.session.query(SpendingRollup)
+        if "category" in group_by:
+            query = query.join(Category, Category.id == SpendingRollup.categoryId)
+        else:
+            query = query.filter(SpendingRollup.categoryId.is_(None))
+        if "user" in group_by:
+            query = query.outerjoin(User, User.id == SpendingRollup.userId)
+        if month_from is not None:
+            query = query.filter(SpendingRollup.month >= month_from)
+        if month_to is not None:
+            query = query.filter(SpendingRollup.month <= month_to)
+
+        group_columns = {
+            "category": Category.categoryName,
+            "user": User.username,
+            "month": SpendingRollup.month
+        }
+        columns = [group_columns[key] for key in group_by]
+        query = query.with_entities(
+            *columns,
+            db.func.sum(SpendingRollup.total),
+            db.func.sum(SpendingRollup.count)
+        )
+        if columns:
+            query = query.group_by(*columns).order_by(*columns)
+
+        items = []
+        for row in query:
+            total, count = row[-2:]
+            if not count:
+                continue
+            item = ReportBuilder(zip(group_by, row))
+            if "user" in item and item["user"] is None:
+                item["user"] = "Null"
+            item["total"] = round(total, 2)
+            item["count"] = count
+            items.append(item)
+
+        body = ReportBuilder(group_by=group_by)
+        body.add_namespace("bumeta", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.reporttotals"))
+        body.add_control("profile", REPORT_PROFILE)
+        body.add_control_all_transactions()
+        body.add_control_all_categories()
+        body.add_control_all_users()
+        body["items"] = items
+
+        return mason_response(body)
@@ -0,0 +1,69 @@
+from flask_restful import Resource
+
+from flask import Flask, Response, request, url_for
+
+from budgethub import db
+from budgethub.models import *
+from budgethub.constants import *
+from budgethub.utils import *
+
+
+def _parse_kinds(args):
+    kinds = [kind for kind in args.get("kind", "").split(",") if kind]
+    for kind in kinds:
+        if kind not in SEARCH_KINDS:
+            raise ValueError("Kind must be a comma separated list of {}".format(", ".join(SEARCH_KINDS)))
+    return kinds
+
+def _parse_search_limit(args):
+    try:
+        limit = int(args.get("limit", DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        raise ValueError("Limit must be an integer")
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise ValueError("Limit must be between 1 and {}".format(MAX_SEARCH_LIMIT))
+    return limit
+
+
+#Search resources
+class SearchResults(Resource):
+    """
+    Prefix search over usernames, category names, ibans and bank names for
+    typeahead fields, e.g. /api/search/?q=us&kind=user&limit=5. Every word of
+    q must start a word of the result. The results come from the search
+    index, so a query takes about as long with a million rows as with ten.
+    """
+
+    @conditional_get(User, Category, BankAccount)
+    def get(self):
+        terms = split_search_terms(request.args.get("q", ""))
+        if not terms:
+            return create_error_response(
+                400, "Invalid query parameter",
+                "q must contain at least one letter or digit"
+            )
+        try:
+            kinds = _parse_kinds(request.args)
+            limit = _parse_search_limit(request.args)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body = SearchBuilder()
+        body.add_namespace("bumeta", LINK_RELATIONS_URL)
+        body.add_control("self", page_url())
+        body.add_control_all_users()
+        body.add_control_all_categories()
+        body.add_control_all_bank_accounts()
+
+        serializers = {}
+        body["items"] = []
+        for kind, name in search(terms, kinds, limit):
+            if kind not in serializers:
+                serializers[kind] = CollectionSerializer(*SEARCH_KINDS[kind])
+            body["items"].append({
+                "kind": kind,
+                "name": name,
+                "@controls": serializers[kind].controls(name)
+            })
+
+        return mason_response(body)
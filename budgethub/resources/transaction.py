@@ -1,9 +1,10 @@
-from jsonschema import validate, ValidationError
-from datetime import datetime
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from datetime import datetime, time
 
 from flask_restful import Resource
 
-from flask import Flask, Response, request, url_for
+from flask import Flask, Response, request, url_for, current_app, stream_with_context
 from werkzeug.exceptions import BadRequest
 from sqlalchemy.exc import IntegrityError
 
@@ -14,64 +15,186 @@ from budgethub.utils import *
 
 
 
+#Columns the transaction lists can be sorted by
+SORT_COLUMNS = {
+    "dateTime": Transaction.dateTime,
+    "price": Transaction.price
+}
+
+
+def _parse_datetime(value, end_of_day=False):
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("'{}' is not an ISO 8601 date or datetime".format(value))
+    if end_of_day and len(value) == 10:
+        parsed = datetime.combine(parsed.date(), time.max)
+    return parsed
+
+def _parse_price(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError("'{}' is not a number".format(value))
+
+def _parse_filters(args):
+    """
+    Reads the transaction filters from the query string. A date without a
+    time in "to" covers the whole day. Raises ValueError for malformed values.
+    """
+
+    filters = {}
+    if "from" in args:
+        filters["date_from"] = _parse_datetime(args["from"])
+    if "to" in args:
+        filters["date_to"] = _parse_datetime(args["to"], end_of_day=True)
+    if "min_price" in args:
+        filters["min_price"] = _parse_price(args["min_price"])
+    if "max_price" in args:
+        filters["max_price"] = _parse_price(args["max_price"])
+    for name in ("sender", "receiver", "category"):
+        if name in args:
+            filters[name] = args[name]
+    return filters
+
+def _parse_cursor(cursor, sort):
+    value, row_id = decode_cursor(cursor, sort)
+    if sort.lstrip("-") == "dateTime":
+        try:
+            return datetime.fromisoformat(value), row_id
+        except (TypeError, ValueError):
+            raise ValueError("Malformed cursor '{}'".format(cursor))
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+    return value, row_id
+
+def _parse_sort(args):
+    sort = args.get("sort", "dateTime")
+    if sort.lstrip("-") not in SORT_COLUMNS:
+        raise ValueError("Transactions can only be sorted by {}".format(
+            ", ".join(SORT_COLUMNS)
+        ))
+    return sort
+
+def _transaction_page(query, args):
+    """
+    Applies the filters, ordering and pagination in the query string to a
+    transaction query. Raises ValueError for invalid query parameters.
+
+    : return: tuple of (transactions, next cursor, previous cursor)
+    """
+
+    sort = _parse_sort(args)
+    sort_column = SORT_COLUMNS[sort.lstrip("-")]
+    limit = parse_limit(args)
+    after = before = None
+    if "after" in args:
+        after = _parse_cursor(args["after"], sort)
+    if "before" in args:
+        before = _parse_cursor(args["before"], sort)
+
+    query = filter_transactions(query, **_parse_filters(args))
+    transactions, has_next, has_prev = keyset_paginate(
+        query, sort_column, Transaction.id, limit,
+        after=after, before=before, descending=sort.startswith("-")
+    )
+
+    next_cursor = prev_cursor = None
+    key = sort.lstrip("-")
+    if has_next:
+        last = transactions[-1]
+        next_cursor = encode_cursor(sort, getattr(last, key), last.id)
+    if has_prev and transactions:
+        first = transactions[0]
+        prev_cursor = encode_cursor(sort, getattr(first, key), first.id)
+    return transactions, next_cursor, prev_cursor
+
+def _item_options(args):
+    """
+    Reads the sparse fieldset and controls parameters for the items. The rows
+    select the sort key even when it isn't returned, since the cursors are
+    made from it. Raises ValueError for invalid query parameters.
+
+    : return: tuple of (item fields, controls, row fields)
+    """
+
+    fields = parse_fields(args, TRANSACTION_FIELDS)
+    key = _parse_sort(args).lstrip("-")
+    row_fields = fields if key in fields else fields + (key,)
+    return fields, parse_controls(args), row_fields
+
+def _wants_stream():
+    return (request.args.get("stream") in ("1", "true")
+            or request.accept_mimetypes.best_match([MASON, NDJSON]) == NDJSON)
+
+def _stream_transactions(query, args, body, fields=TRANSACTION_FIELDS, controls=True):
+    """
+    Returns a streaming response with every transaction the query string
+    selects, in the requested order. Rows are read from the database in
+    batches and each item is written out as soon as it has been built, so
+    memory use doesn't grow with the table. The items are sent as NDJSON if
+    the client accepts it, otherwise as one Mason document whose items array
+    is written incrementally. Raises ValueError for invalid query parameters.
+    """
+
+    sort = _parse_sort(args)
+    sort_column = SORT_COLUMNS[sort.lstrip("-")]
+    query = filter_transactions(query, **_parse_filters(args))
+    if sort.startswith("-"):
+        query = query.order_by(sort_column.desc(), Transaction.id.desc())
+    else:
+        query = query.order_by(sort_column.asc(), Transaction.id.asc())
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+
+    if request.accept_mimetypes.best_match([MASON, NDJSON]) == NDJSON:
+        def generate():
+            for item in transaction_items(rows, fields, controls):
+                yield encode_json(item) + b"\n"
+        return Response(stream_with_context(generate()), 200, mimetype=NDJSON)
+
+    def generate():
+        yield encode_json(body)[:-1] + b',"items":['
+        separator = b""
+        for item in transaction_items(rows, fields, controls):
+            yield separator + encode_json(item)
+            separator = b","
+        yield b"]}"
+    return Response(stream_with_context(generate()), 200, mimetype=MASON)
+
+
 #Transaction resources
 class TransactionCollection(Resource):
+    @conditional_get(Transaction, User, Category)
     def get(self):
         body = TransactionBuilder()
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
-        body.add_control("self", "/api/users/")
+        body.add_control("self", url_for("api.transactioncollection"))
         body.add_control_add_transaction()
+        body.add_control_bulk_add_transactions()
         body.add_control_all_bank_accounts()
         body.add_control_all_categories()
         body.add_control_all_users()
 
-        items = []
-        for transaction in Transaction.query.all():
-            try:
-                transaction_item_body = TransactionBuilder(
-                    id = transaction.id,
-                    price = transaction.price,
-                    dateTime = str(transaction.dateTime),
-                    sender = transaction.sender.username,
-                    receiver = transaction.receiver.username,
-                    category = [cat.categoryName for cat in transaction.category]
+        try:
+            fields, controls, row_fields = _item_options(request.args)
+            if _wants_stream():
+                return _stream_transactions(
+                    transaction_rows(row_fields), request.args, body, fields, controls
                 )
-            except AttributeError:
-                try:
-                    transaction_item_body = TransactionBuilder(
-                        id = transaction.id,
-                        price = transaction.price,
-                        dateTime = str(transaction.dateTime),
-                        sender = "Null",
-                        receiver = transaction.receiver.username,
-                        category = [cat.categoryName for cat in transaction.category]
-                    )
-                except AttributeError:
-                    try:
-                        transaction_item_body = TransactionBuilder(
-                            id = transaction.id,
-                            price = transaction.price,
-                            dateTime = str(transaction.dateTime),
-                            sender = transaction.sender.username,
-                            receiver = "Null",
-                            category = [cat.categoryName for cat in transaction.category]
-                        )
-                    except AttributeError:
-                            transaction_item_body = TransactionBuilder(
-                            id = transaction.id,
-                            price = transaction.price,
-                            dateTime = str(transaction.dateTime),
-                            sender = "Null",
-                            receiver = "Null",
-                            category = [cat.categoryName for cat in transaction.category]
-                        )
-
-            transaction_item_body.add_control("self", url_for("api.transactionitem", transaction_id=transaction.id))
-            transaction_item_body.add_control("profile", TRANSACTION_PROFILE)
-            items.append(transaction_item_body)
-        body["items"] = items
-
-        return Response(json.dumps(body), 200, mimetype=MASON)
+            transactions, next_cursor, prev_cursor = _transaction_page(
+                transaction_rows(row_fields), request.args
+            )
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        if next_cursor:
+            body.add_control_next_page(next_cursor)
+        if prev_cursor:
+            body.add_control_prev_page(prev_cursor)
+
+        body["items"] = list(transaction_items(transactions, fields, controls))
+
+        return mason_response(body)
 
     def post(self):
         if not request.json:
@@ -81,32 +204,27 @@ class TransactionCollection(Resource):
             )
 
         try:
-            validate(request.json, TransactionBuilder.transaction_schema())
+            schema_registry.validate("transaction", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        db_sender = User.query.filter_by(username=request.json["sender"]).first()
-        if db_sender is None:
+        db_users, missing = resolve_names(
+            User.username, [request.json["sender"], request.json["receiver"]]
+        )
+        if missing:
             return create_error_response(
                 404, "Not found",
-                "No user was found with the username {}".format(request.json["sender"])
+                "No user was found with the username(s) {}".format(", ".join(map(str, missing)))
             )
-        db_receiver = User.query.filter_by(username=request.json["receiver"]).first()
-        if db_receiver is None:
+        db_sender = db_users[request.json["sender"]]
+        db_receiver = db_users[request.json["receiver"]]
+        db_categories, missing = resolve_names(Category.categoryName, request.json.get("category", []))
+        if missing:
             return create_error_response(
                 404, "Not found",
-                "No user was found with the username {}".format(request.json["receiver"])
+                "No category was found with the categoryname(s) {}".format(", ".join(map(str, missing)))
             )
-        db_category_list = []
-        for cat in request.json["category"]:
-            db_category = Category.query.filter_by(categoryName=cat).first()
-            if db_category is None:
-                return create_error_response(
-                    404, "Not found",
-                    "No category was found with the categoryname(s) {}".format(request.json["category"])
-                )
-            db_category_list.append(db_category)
-        
+        db_category_list = list(db_categories.values())
 
         transaction = Transaction(
             price=request.json["price"],
@@ -117,6 +235,12 @@ class TransactionCollection(Resource):
         )
 
         db.session.add(transaction)
+        update_rollups([(
+            transaction.price, transaction.dateTime, db_sender.id,
+            [cat.id for cat in db_category_list]
+        )])
+        update_balances([(transaction.price, db_sender.id, db_receiver.id)])
+        bump_table_versions(Transaction)
         db.session.commit()
 
 
@@ -124,55 +248,184 @@ class TransactionCollection(Resource):
             "Location": url_for("api.transactionitem", transaction_id=transaction.id)
         })
 
+def _read_bulk_items():
+    """
+    Reads the items of a bulk request, either a JSON array or one JSON
+    document per line. Lines that are not valid JSON are returned as None.
+    Raises ValueError if the body as a whole can't be read.
+    """
+
+    if request.mimetype == NDJSON:
+        items = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+        return items
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        raise ValueError("Bulk requests must be a JSON array or NDJSON")
+    return items
+
+
+class TransactionBulk(Resource):
+    """
+    Creates many transactions in one request. Party and category names are
+    resolved with one query per entity type for the whole batch and the rows
+    are inserted with one executemany per chunk inside a single database
+    transaction, every chunk in a savepoint of its own. Items that fail validation are reported back
+    with their index and skipped, and a chunk the database rejects is
+    reported for each of its items; the rest of the batch is still created.
+    """
+
+    def post(self):
+        if not (request.is_json or request.mimetype == NDJSON):
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON or NDJSON"
+            )
+        try:
+            chunk_size = int(request.args.get(
+                "chunk_size", current_app.config["BULK_CHUNK_SIZE"]))
+            if chunk_size < 1:
+                raise ValueError
+        except ValueError:
+            return create_error_response(
+                400, "Invalid query parameter",
+                "Chunk size must be a positive integer"
+            )
+        try:
+            items = _read_bulk_items()
+        except ValueError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        validator = schema_registry.validator("transaction")
+        errors = []
+        valid = []
+        for index, item in enumerate(items):
+            if item is None:
+                errors.append({"index": index, "message": "Invalid JSON"})
+                continue
+            error = best_match(validator.iter_errors(item))
+            if error is not None:
+                errors.append({"index": index, "message": error.message})
+                continue
+            try:
+                date_time = _parse_datetime(item["datetime"]) if "datetime" in item else datetime.now()
+            except ValueError as e:
+                errors.append({"index": index, "message": str(e)})
+                continue
+            valid.append((index, item, date_time))
+
+        db_users, _ = resolve_names(User.username, [
+            name for _, item, _ in valid for name in (item["sender"], item["receiver"])
+        ])
+        db_categories, _ = resolve_names(Category.categoryName, [
+            name for _, item, _ in valid for name in item.get("category", [])
+        ])
+
+        rows = []
+        for index, item, date_time in valid:
+            missing = [
+                name for name in (item["sender"], item["receiver"])
+                if name not in db_users
+            ]
+            if missing:
+                errors.append({"index": index, "message": "No user was found with the username(s) {}".format(", ".join(map(str, missing)))})
+                continue
+            categories = list(dict.fromkeys(item.get("category", [])))
+            missing = [name for name in categories if name not in db_categories]
+            if missing:
+                errors.append({"index": index, "message": "No category was found with the categoryname(s) {}".format(", ".join(map(str, missing)))})
+                continue
+            rows.append((index, {
+                "price": item["price"],
+                "dateTime": date_time,
+                "senderId": db_users[item["sender"]].id,
+                "receiverId": db_users[item["receiver"]].id
+            }, [db_categories[name].id for name in categories]))
+
+        # the first write opens the transaction, pysqlite would otherwise
+        # make the first savepoint the outer transaction and commit it early
+        bump_table_versions(Transaction)
+        # executemany doesn't return the ids, so they are given here; the
+        # write above holds the database lock until the commit
+        next_id = (db.session.query(db.func.max(Transaction.id)).scalar() or 0) + 1
+        created = []
+        inserted = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            for offset, (_, transaction, _) in enumerate(chunk):
+                transaction["id"] = next_id + offset
+            links = [
+                {"transactionId": transaction["id"], "categoryId": category_id}
+                for _, transaction, category_ids in chunk
+                for category_id in category_ids
+            ]
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(Transaction.__table__.insert(), [transaction for _, transaction, _ in chunk])
+                    if links:
+                        db.session.execute(transaction_category_association_table.insert(), links)
+            except IntegrityError as e:
+                for index, _, _ in chunk:
+                    errors.append({"index": index, "message": "Rejected by the database: {}".format(e.orig)})
+                continue
+            next_id += len(chunk)
+            created.extend({"index": index, "id": transaction["id"]} for index, transaction, _ in chunk)
+            inserted.extend(chunk)
+        update_rollups([
+            (transaction["price"], transaction["dateTime"], transaction["senderId"], category_ids)
+            for _, transaction, category_ids in inserted
+        ])
+        update_balances([
+            (transaction["price"], transaction["senderId"], transaction["receiverId"])
+            for _, transaction, _ in inserted
+        ])
+        db.session.commit()
+
+        errors.sort(key=lambda error: error["index"])
+        body = TransactionBuilder(
+            created=len(created),
+            failed=len(errors),
+            items=created,
+            errors=errors
+        )
+        body.add_namespace("bumeta", LINK_RELATIONS_URL)
+        body.add_control("self", url_for("api.transactionbulk"))
+        body.add_control("bumeta:transactions-all", url_for("api.transactioncollection"))
+
+        return mason_response(body)
+
+
 class TransactionItem(Resource):
+    @conditional_get(Transaction, User, Category)
     def get(self, transaction_id):
-        db_transaction = Transaction.query.filter_by(id=transaction_id).first()
+        db_transaction = transaction_query().filter_by(id=transaction_id).first()
         if db_transaction is None:
             return create_error_response(
                 404, "Not found",
                 "No transaction was found with the id {}".format(transaction_id)
             )
-        try:
-            body = TransactionBuilder(
-                price=db_transaction.price,
-                dateTime=str(db_transaction.dateTime),
-                sender=db_transaction.sender.username,
-                receiver=db_transaction.receiver.username,
-                category=[cat.categoryName for cat in db_transaction.category]
-                )
-        except AttributeError:
-            try:
-                body = TransactionBuilder(
-                    price=db_transaction.price,
-                    dateTime=str(db_transaction.dateTime),
-                    sender="Null",
-                    receiver=db_transaction.receiver.username,
-                    category=[cat.categoryName for cat in db_transaction.category]
-                    )
-            except AttributeError:
-                try:
-                    body = TransactionBuilder(
-                    price=db_transaction.price,
-                    dateTime=str(db_transaction.dateTime),
-                    sender=db_transaction.sender.username,
-                    receiver="Null",
-                    category=[cat.categoryName for cat in db_transaction.category]
-                    )
-                except AttributeError:
-                    body = TransactionBuilder(
-                    price=db_transaction.price,
-                    dateTime=str(db_transaction.dateTime),
-                    sender="Null",
-                    receiver="Null",
-                    category=[cat.categoryName for cat in db_transaction.category]
-                    )
+        sender, receiver = db_transaction.sender, db_transaction.receiver
+        body = TransactionBuilder(
+            price=db_transaction.price,
+            dateTime=db_transaction.dateTime,
+            sender=sender.username if sender is not None else "Null",
+            receiver=receiver.username if receiver is not None else "Null",
+            category=[cat.categoryName for cat in db_transaction.category]
+        )
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.transactionitem", transaction_id=transaction_id))
         body.add_control("profile", TRANSACTION_PROFILE)
         body.add_control("bumeta:transactions-all", url_for("api.transactioncollection"))
         body.add_control_delete_transaction(transaction_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def delete(self, transaction_id):
         db_transaction = Transaction.query.filter_by(id=transaction_id).first()
@@ -182,7 +435,97 @@ class TransactionItem(Resource):
                 "No transaction was found with the id {}".format(transaction_id)
             )
 
+        update_rollups([(
+            db_transaction.price, db_transaction.dateTime, db_transaction.senderId,
+            [cat.id for cat in db_transaction.category]
+        )], sign=-1)
+        update_balances([(
+            db_transaction.price, db_transaction.senderId, db_transaction.receiverId
+        )], sign=-1)
         db.session.delete(db_transaction)
+        bump_table_versions(Transaction)
         db.session.commit()
 
         return Response(status=204)
+
+
+class CategoryTransactionCollection(Resource):
+    @conditional_get(Transaction, User, Category)
+    def get(self, category_name):
+        db_category = Category.query.filter_by(categoryName=category_name).first()
+        if db_category is None:
+            return create_error_response(
+                404, "Not found",
+                "No category was found with a name {}".format(category_name)
+            )
+
+        try:
+            fields, controls, row_fields = _item_options(request.args)
+            transactions, next_cursor, prev_cursor = _transaction_page(
+                transactions_in_category(db_category, transaction_rows(row_fields)), request.args
+            )
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body = TransactionBuilder()
+        body.add_namespace("bumeta", LINK_RELATIONS_URL)
+        body.add_control("self", url_for(
+            "api.categorytransactioncollection", category_name=category_name))
+        body.add_control(
+            "bumeta:category",
+            url_for("api.categoryitem", category_name=category_name),
+            title="This category"
+        )
+        body.add_control(
+            "bumeta:transactions-all",
+            url_for("api.transactioncollection"),
+            title="All transactions"
+        )
+        if next_cursor:
+            body.add_control_next_page(next_cursor)
+        if prev_cursor:
+            body.add_control_prev_page(prev_cursor)
+        body["items"] = list(transaction_items(transactions, fields, controls))
+
+        return mason_response(body)
+
+
+class UserTransactionCollection(Resource):
+    @conditional_get(Transaction, User, Category)
+    def get(self, username):
+        db_user = User.query.filter_by(username=username).first()
+        if db_user is None:
+            return create_error_response(
+                404, "Not found",
+                "No user was found with the username {}".format(username)
+            )
+
+        try:
+            fields, controls, row_fields = _item_options(request.args)
+            transactions, next_cursor, prev_cursor = _transaction_page(
+                transactions_by_user(db_user, transaction_rows(row_fields)), request.args
+            )
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        body = TransactionBuilder()
+        body.add_namespace("bumeta", LINK_RELATIONS_URL)
+        body.add_control("self", url_for(
+            "api.usertransactioncollection", username=username))
+        body.add_control(
+            "bumeta:user",
+            url_for("api.useritem", username=username),
+            title="This user"
+        )
+        body.add_control(
+            "bumeta:transactions-all",
+            url_for("api.transactioncollection"),
+            title="All transactions"
+        )
+        if next_cursor:
+            body.add_control_next_page(next_cursor)
+        if prev_cursor:
+            body.add_control_prev_page(prev_cursor)
+        body["items"] = list(transaction_items(transactions, fields, controls))
+
+        return mason_response(body)
@@ -4,7 +4,7 @@ from flask import Flask, Response, request, url_for
 from werkzeug.exceptions import BadRequest
 from sqlalchemy.exc import IntegrityError
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from budgethub import db
 from budgethub.models import *
 from budgethub.constants import *
@@ -12,6 +12,7 @@ from budgethub.utils import *
 
 #User resources
 class UserCollection(Resource):
+    @conditional_get(User, BankAccount, Transaction)
     def get(self):
         body = UserBuilder()
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
@@ -21,19 +22,14 @@ class UserCollection(Resource):
         body.add_control_all_categories()
         body.add_control_all_transactions()
 
-        items = []
-        for user in User.query.all():
-            user_item_body = UserBuilder(
-                username = user.username,
-                bankAccount = [bankaccount.iban for bankaccount in user.bankAccount]
-
-            )
-            user_item_body.add_control("self", url_for("api.useritem", username=user.username))
-            user_item_body.add_control("profile", USER_PROFILE)
-            items.append(user_item_body)
-        body["items"] = items
+        try:
+            fields = parse_fields(request.args, USER_FIELDS)
+            controls = parse_controls(request.args)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        body["items"] = user_items(user_rows(fields), fields, controls)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def post(self):
         if not request.json:
@@ -43,31 +39,26 @@ class UserCollection(Resource):
             )
 
         try:
-            validate(request.json, UserBuilder.create_user_schema())
+            schema_registry.validate("create-user", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        #TODO add bankaccount. i.e find bankaccount object from db
-        #and link it to user.
-
-        db_bankaccount_list = []
-        for iban in request.json["bankAccount"]:
-            db_bankaccount = BankAccount.query.filter_by(iban=iban).first()
-            if db_bankaccount is None:
-                return create_error_response(
-                    404, "Not found",
-                    "No bank account was found with the iban(s) {}".format(request.json["bankAccount"])
-                )
-            db_bankaccount_list.append(db_bankaccount)
+        db_bankaccounts, missing = resolve_names(BankAccount.iban, request.json["bankAccount"])
+        if missing:
+            return create_error_response(
+                404, "Not found",
+                "No bank account was found with the iban(s) {}".format(", ".join(map(str, missing)))
+            )
 
         user = User(
             username=request.json["username"],
             password=request.json["password"],
-            bankAccount=db_bankaccount_list
+            bankAccount=list(db_bankaccounts.values())
         )
 
         try:
             db.session.add(user)
+            bump_table_versions(User)
             db.session.commit()
         except IntegrityError:
             return create_error_response(
@@ -80,8 +71,9 @@ class UserCollection(Resource):
         })
 
 class UserItem(Resource):
+    @conditional_get(User, BankAccount, Transaction)
     def get(self, username):
-        db_user = User.query.filter_by(username=username).first()
+        db_user = user_query().filter_by(username=username).first()
         if db_user is None:
             return create_error_response(
                 404, "Not found",
@@ -90,16 +82,18 @@ class UserItem(Resource):
 
         body = UserBuilder(
                 username = db_user.username,
+                balance = db_user.balance,
                 bankAccount = [bankaccount.iban for bankaccount in db_user.bankAccount]
             )
         body.add_namespace("bumeta", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.useritem", username=username))
         body.add_control("profile", USER_PROFILE)
         body.add_control("bumeta:users-all", url_for("api.usercollection"))
+        body.add_control_transactions_by(username)
         body.add_control_delete_user(username)
         body.add_control_edit_user(username)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
     def put(self, username):
         db_user = User.query.filter_by(username=username).first()
@@ -116,25 +110,23 @@ class UserItem(Resource):
             )
 
         try:
-            validate(request.json, UserBuilder.create_user_schema())
+            schema_registry.validate("create-user", request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
+        db_bankaccounts, missing = resolve_names(BankAccount.iban, request.json["bankAccount"])
+        if missing:
+            return create_error_response(
+                404, "Not found",
+                "No bank account was found with the iban(s) {}".format(", ".join(map(str, missing)))
+            )
 
-
-        for iban in request.json["bankAccount"]:
-            db_bankaccount = BankAccount.query.filter_by(iban=iban).first()
-            if db_bankaccount is None:
-                return create_error_response(
-                    404, "Not found",
-                    "No bank account was found with the iban(s) {}".format(request.json["bankAccount"])
-                )
-            db_user.bankAccount.append(db_bankaccount)
-
+        #PUT replaces the user, so accounts left out of the list are unlinked
+        replace_related(db_user.bankAccount, db_bankaccounts.values())
         db_user.username = request.json["username"]
         db_user.password = request.json["password"]
 
-
         try:
+            bump_table_versions(User)
             db.session.commit()
         except IntegrityError:
             db.session.rollback()
@@ -153,7 +145,10 @@ class UserItem(Resource):
                 "No user was found with the username {}".format(username)
             )
 
+        # the sender of the rollup rows is set to NULL with the user
+        merge_user_rollups(db_user.id)
         db.session.delete(db_user)
+        bump_table_versions(User)
         db.session.commit()
 
         return Response(status=204)
@@ -1,6 +1,21 @@
 import json
-from flask import request, Response, url_for
+import base64
+import hashlib
+import functools
+import itertools
+from datetime import datetime
+from flask import current_app, request, Response, url_for
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from sqlalchemy import and_, or_
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from budgethub.cache import response_cache
+from budgethub.compression import etag_variants
 from budgethub.constants import *
 from budgethub.models import *
 
@@ -105,7 +120,8 @@ class TransactionBuilder(MasonBuilder):
         props["category"] = {
             "description": "Transaction's category",
             #TODO: onko string vai lista?
-            "type": "array"
+            "type": "array",
+            "items": {"type": "string"}
         }
         return schema
 
@@ -148,7 +164,7 @@ class TransactionBuilder(MasonBuilder):
             href="/api/bankaccounts/",
             method="POST",
             encoding="json",
-            schema=self.bank_account_schema()
+            schema=schema_registry.schema("bank-account")
         )"""
 
     def add_control_add_transaction(self):
@@ -157,9 +173,35 @@ class TransactionBuilder(MasonBuilder):
             href="/api/transactions/",
             method="POST",
             encoding="json",
-            schema=self.transaction_schema()
+            schema=schema_registry.schema("transaction")
         )
     
+    def add_control_bulk_add_transactions(self):
+        self.add_control(
+            ctrl_name="bumeta:bulk-add-transactions",
+            href="/api/transactions/bulk/",
+            method="POST",
+            encoding="json",
+            title="Add many transactions as a JSON array or NDJSON",
+            schema=schema_registry.schema("transaction-list")
+        )
+
+    def add_control_next_page(self, cursor):
+        self.add_control(
+            "next",
+            page_url(after=cursor),
+            method="GET",
+            title="Leads to the next page of transactions"
+        )
+
+    def add_control_prev_page(self, cursor):
+        self.add_control(
+            "prev",
+            page_url(before=cursor),
+            method="GET",
+            title="Leads to the previous page of transactions"
+        )
+
     def add_control_delete_transaction(self, transaction_id):
         self.add_control(
             ctrl_name="bumeta:delete",
@@ -222,7 +264,7 @@ class CategoryBuilder(MasonBuilder):
             href="/api/bankaccounts/",
             method="POST",
             encoding="json",
-            schema=self.bank_account_schema()
+            schema=schema_registry.schema("bank-account")
         )"""
 
     def add_control_add_category(self):
@@ -231,7 +273,7 @@ class CategoryBuilder(MasonBuilder):
             href="/api/categories/",
             method="POST",
             encoding="json",
-            schema=self.category_schema()
+            schema=schema_registry.schema("category")
         )
     
     def add_control_delete_category(self, category_name):
@@ -242,13 +284,21 @@ class CategoryBuilder(MasonBuilder):
             title="Delete this resource"
         )
 
+    def add_control_transactions_in(self, category_name):
+        self.add_control(
+            "bumeta:transaction-in",
+            url_for("api.categorytransactioncollection", category_name=category_name),
+            method="GET",
+            title="Leads to the transactions in this category"
+        )
+
     def add_control_edit_category(self, category_name):
         self.add_control(
             ctrl_name="edit",
             href=url_for("api.categoryitem", category_name=category_name),
             method="PUT",
             encoding="json",
-            schema=self.category_schema()
+            schema=schema_registry.schema("category")
         )
 
 #user builder
@@ -270,7 +320,8 @@ class UserBuilder(MasonBuilder):
         }
         props["bankAccount"] = {
             "description": "User's bankAccount(s)",
-            "type": "array"
+            "type": "array",
+            "items": {"type": "string"}
         }
 
         return schema
@@ -292,7 +343,8 @@ class UserBuilder(MasonBuilder):
         }
         props["bankAccount"] = {
             "description": "User's bankAccount(s)",
-            "type": "array"
+            "type": "array",
+            "items": {"type": "string"}
         }
 
         return schema
@@ -335,7 +387,7 @@ class UserBuilder(MasonBuilder):
             href="/api/bankaccounts/",
             method="POST",
             encoding="json",
-            schema=self.bank_account_schema()
+            schema=schema_registry.schema("bank-account")
         )"""
 
     def add_control_add_user(self):
@@ -344,7 +396,7 @@ class UserBuilder(MasonBuilder):
             href="/api/users/",
             method="POST",
             encoding="json",
-            schema=self.user_schema()
+            schema=schema_registry.schema("user")
         )
     
     def add_control_delete_user(self, username):
@@ -355,13 +407,21 @@ class UserBuilder(MasonBuilder):
             title="Delete this resource"
         )
 
+    def add_control_transactions_by(self, username):
+        self.add_control(
+            "bumeta:transaction-by",
+            url_for("api.usertransactioncollection", username=username),
+            method="GET",
+            title="Leads to the transactions sent or received by this user"
+        )
+
     def add_control_edit_user(self, username):
         self.add_control(
             ctrl_name="edit",
             href=url_for("api.useritem", username=username),
             method="PUT",
             encoding="json",
-            schema=self.user_schema()
+            schema=schema_registry.schema("user")
         )
 
 #bank account builder
@@ -422,7 +482,7 @@ class BankAccountBuilder(MasonBuilder):
             href="/api/bankaccounts/",
             method="POST",
             encoding="json",
-            schema=self.bank_account_schema()
+            schema=schema_registry.schema("bank-account")
         )
     
     def add_control_delete_bank_account(self, iban):
@@ -439,13 +499,555 @@ class BankAccountBuilder(MasonBuilder):
             href=url_for("api.bankaccountitem", iban=iban),
             method="PUT",
             encoding="json",
-            schema=self.bank_account_schema()
+            schema=schema_registry.schema("bank-account")
+        )
+
+#report builder
+class ReportBuilder(MasonBuilder):
+    def add_control_all_transactions(self):
+        self.add_control(
+            "bumeta:transactions-all",
+            "/api/transactions/",
+            method="GET",
+            title="Leads to the list of all transactions"
+        )
+
+    def add_control_all_categories(self):
+        self.add_control(
+            "bumeta:categories-all",
+            "/api/categories/",
+            method="GET",
+            title="Leads to the list of all categories"
+        )
+
+    def add_control_all_users(self):
+        self.add_control(
+            "bumeta:users-all",
+            "/api/users/",
+            method="GET",
+            title="Leads to the list of all users"
+        )
+
+#search builder
+class SearchBuilder(MasonBuilder):
+    def add_control_all_categories(self):
+        self.add_control(
+            "bumeta:categories-all",
+            "/api/categories/",
+            method="GET",
+            title="Leads to the list of all categories"
+        )
+
+    def add_control_all_users(self):
+        self.add_control(
+            "bumeta:users-all",
+            "/api/users/",
+            method="GET",
+            title="Leads to the list of all users"
+        )
+
+    def add_control_all_bank_accounts(self):
+        self.add_control(
+            "bumeta:bank-accounts-all",
+            "/api/bankaccounts/",
+            method="GET",
+            title="Leads to the list of all bank accounts"
         )
 
+##Schema registry
+class FrozenDict(dict):
+    """
+    A dict that can't be modified after it's created. Used for the schemas
+    shared by every request, so that no handler can change them by accident.
+    Still a dict, so it serializes and validates like one.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Shared schemas are read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+class FrozenList(list):
+    """
+    The list counterpart of FrozenDict.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Shared schemas are read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = clear = extend = insert = pop = remove = reverse = sort = _readonly
+
+def freeze(value):
+    """
+    Returns a read-only deep copy of a JSON-like value.
+    """
+
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+class SchemaRegistry(object):
+    """
+    Holds every request schema of the API together with its compiled
+    validator. jsonschema.validate checks the schema itself and builds a new
+    validator on every call, here that is done once when the app is created.
+    The schema controls of the builders and the resources share the same
+    frozen schema objects.
+    """
+
+    SCHEMAS = {
+        "transaction": lambda: TransactionBuilder.transaction_schema(),
+        "transaction-list": lambda: {
+            "type": "array",
+            "items": TransactionBuilder.transaction_schema()
+        },
+        "category": lambda: CategoryBuilder.category_schema(),
+        "user": lambda: UserBuilder.user_schema(),
+        "create-user": lambda: UserBuilder.create_user_schema(),
+        "bank-account": lambda: BankAccountBuilder.bank_account_schema()
+    }
+
+    def __init__(self):
+        self.schemas = {}
+        self.validators = {}
+
+    def compile(self):
+        for name, build in self.SCHEMAS.items():
+            schema = freeze(build())
+            Draft7Validator.check_schema(schema)
+            self.schemas[name] = schema
+            self.validators[name] = Draft7Validator(schema)
+
+    def schema(self, name):
+        if name not in self.schemas:
+            self.compile()
+        return self.schemas[name]
+
+    def validator(self, name):
+        if name not in self.validators:
+            self.compile()
+        return self.validators[name]
+
+    def validate(self, name, document):
+        """
+        Validates a document against the named schema. Raises the same
+        ValidationError that jsonschema.validate would.
+        """
+
+        error = best_match(self.validator(name).iter_errors(document))
+        if error is not None:
+            raise error
+
+schema_registry = SchemaRegistry()
+
+
+##JSON encoding
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+def _stdlib_dumps(value):
+    return json.dumps(
+        value, separators=(",", ":"), ensure_ascii=False, default=_json_default
+    ).encode("utf-8")
+
+def _orjson_dumps(value):
+    return orjson.dumps(value, default=_json_default)
+
+# Both write compact UTF-8 with datetimes in ISO 8601 and decode to the
+# same values, orjson just writes them faster. The bytes of some floats
+# differ: json writes 1e-07 where orjson writes 1e-7, and json writes NaN
+# and Infinity, which aren't JSON, where orjson writes null.
+JSON_BACKENDS = {"json": _stdlib_dumps}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = _orjson_dumps
+
+def encode_json(value):
+    """
+    Encodes a value to compact UTF-8 JSON with the backend chosen by the
+    JSON_BACKEND setting. The default, "auto", uses orjson when it's
+    installed and the standard library otherwise.
+    """
+
+    name = current_app.config.get("JSON_BACKEND", "auto")
+    if name == "auto":
+        name = "orjson" if "orjson" in JSON_BACKENDS else "json"
+    return JSON_BACKENDS[name](value)
+
+def mason_response(body, status_code=200, mimetype=MASON, **kwargs):
+    """
+    Returns a response with the encoded body. Every Mason response of the
+    API is made here.
+    """
+
+    return Response(encode_json(body), status_code, mimetype=mimetype, **kwargs)
+
+
 ##Create MASON error messages
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return mason_response(body, status_code)
+
+
+##Conditional GET
+def make_etag(models):
+    """
+    Builds a strong ETag for the current request from the change counters of
+    the tables its representation is made of. The URL and the negotiated
+    media type are part of the tag, so every variant gets its own. The tag
+    doubles as the key of the response cache.
+    """
+
+    versions = table_versions(*models)
+    key = "|".join([
+        request.full_path,
+        request.accept_mimetypes.best_match([MASON, NDJSON]) or MASON
+    ] + ["{}={}".format(name, versions[name]) for name in sorted(versions)])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def conditional_get(*models):
+    """
+    Decorator for GET handlers whose representation is built from the tables
+    of the given models. Answers 304 Not Modified when the client's
+    If-None-Match matches, without calling the handler at all, and adds the
+    ETag to successful responses otherwise. Successful responses are kept in
+    the response cache and served from there until one of the tables is
+    written to.
+    """
+
+    tables = [model.__tablename__ for model in models]
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(models)
+            for tag in etag_variants(etag):
+                if request.if_none_match.contains(tag):
+                    response = Response(status=304)
+                    response.set_etag(tag)
+                    response.vary.add("Accept")
+                    return response
+
+            #The engine URL keeps apps on different databases apart
+            use_cache = response_cache.enabled()
+            cache_key = (str(db.engine.url), etag)
+            cached = response_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                response = Response(cached.body, 200, mimetype=cached.mimetype)
+            else:
+                response = func(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                if use_cache:
+                    response_cache.put(cache_key, response, tables)
+            response.set_etag(etag)
+            response.vary.add("Accept")
+            return response
+        return wrapper
+    return decorator
+
+
+##Keyset pagination
+def encode_cursor(sort, value, row_id):
+    """
+    Encodes the sort key value and id of a row into an opaque, URL safe
+    cursor. The name of the sort key is stored in the cursor too, so that a
+    cursor can't be used with a different ordering than it was made for.
+
+    : param str sort: name of the sort key
+    : param value: value of the sort key in the row
+    : param int row_id: id of the row
+    """
+
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([sort, value, row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort):
+    """
+    Decodes a cursor made by encode_cursor. Raises ValueError if the cursor
+    is malformed or was made for another sort key.
+
+    : param str cursor: the cursor from the query string
+    : param str sort: name of the sort key currently used
+    : return: tuple of (sort key value, row id)
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key, value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+    if key != sort or not isinstance(row_id, int):
+        raise ValueError("Cursor '{}' is not valid for this ordering".format(cursor))
+    return value, row_id
+
+def parse_limit(args):
+    """
+    Reads the page size from the query string. Raises ValueError if it is not
+    an integer between 1 and MAX_PAGE_SIZE.
+    """
+
+    try:
+        limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Limit must be an integer")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError("Limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+    return limit
+
+def parse_fields(args, available):
+    """
+    Reads the sparse fieldset from the fields parameter of the query string,
+    e.g. ?fields=price,dateTime. Raises ValueError for unknown field names.
+
+    : param available: all fields of the items, in the order they are written
+    : return: the requested fields in the order of available, all of them if
+    the parameter is missing
+    """
+
+    if "fields" not in args:
+        return available
+    requested = set(name.strip() for name in args["fields"].split(",") if name.strip())
+    unknown = requested.difference(available)
+    if unknown or not requested:
+        raise ValueError("Fields must be a comma separated list of {}".format(", ".join(available)))
+    return tuple(name for name in available if name in requested)
+
+def parse_controls(args):
+    """
+    Reads the controls parameter of the query string. ?controls=none leaves
+    the controls of the items out. Raises ValueError for other values than
+    none and all.
+    """
+
+    controls = args.get("controls", "all")
+    if controls not in ("all", "none"):
+        raise ValueError("Controls must be all or none")
+    return controls == "all"
+
+def parse_embed(args):
+    """
+    Reads ?embed=transactions and the number of transactions to embed from
+    the limit parameter of the query string. Raises ValueError for anything
+    else than transactions, or a limit that is not an integer between 1 and
+    MAX_EMBED_LIMIT.
+
+    : return: the number of transactions to embed, None if embed is missing
+    """
+
+    embed = args.get("embed")
+    if embed is None:
+        return None
+    if embed != "transactions":
+        raise ValueError("Only transactions can be embedded")
+    try:
+        limit = int(args.get("limit", DEFAULT_EMBED_LIMIT))
+    except ValueError:
+        raise ValueError("Limit must be an integer")
+    if not 1 <= limit <= MAX_EMBED_LIMIT:
+        raise ValueError("Limit must be between 1 and {}".format(MAX_EMBED_LIMIT))
+    return limit
+
+def page_url(**params):
+    """
+    Returns the URL of the current resource with the pagination cursor
+    replaced by the given one. Other query parameters are kept as they are.
+    """
+
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args.update(params)
+    args.update(request.view_args)
+    return url_for(request.endpoint, **args)
+
+def keyset_paginate(query, sort_column, id_column, limit, after=None, before=None, descending=False):
+    """
+    Returns one page of the query ordered by (sort_column, id_column). The
+    page is located by comparing against the keys of the previous page's
+    boundary row instead of using OFFSET, so every page costs the same no
+    matter how deep the client pages. At most one of after and before should
+    be given.
+
+    : param query: the query to paginate
+    : param sort_column: column the page is ordered by
+    : param id_column: unique column used to break ties
+    : param int limit: maximum number of rows on the page
+    : param after: (value, id) of the row preceding the page
+    : param before: (value, id) of the row following the page
+    : param bool descending: order the rows from the largest sort key
+    : return: tuple of (rows, has_next, has_prev)
+    """
+
+    backward = before is not None
+    cursor = before if backward else after
+    ascending = descending == backward
+    if cursor is not None:
+        value, row_id = cursor
+        if ascending:
+            query = query.filter(and_(
+                sort_column >= value,
+                or_(sort_column > value, id_column > row_id)
+            ))
+        else:
+            query = query.filter(and_(
+                sort_column <= value,
+                or_(sort_column < value, id_column < row_id)
+            ))
+
+    if ascending:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+    else:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if backward:
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, after is not None
+
+
+
+##Collection serializers
+class CollectionSerializer(object):
+    """
+    Builds collection items straight from row tuples. Building a builder
+    object per row and calling url_for for every self link is most of the
+    cost of a large collection, so the self href is split once into a prefix
+    and suffix around the key, and the profile control is one dict shared by
+    every item. The items serialize to exactly the same JSON as the ones
+    made with the builders.
+    """
+
+    KEY = "__key__"
+
+    def __init__(self, endpoint, key_arg, profile):
+        self.prefix, self.suffix = url_for(endpoint, **{key_arg: self.KEY}).split(self.KEY)
+        self.quote = current_app.url_map.converters["default"](current_app.url_map).to_url
+        self.profile = {"href": profile}
+
+    def href(self, key):
+        # ids never need quoting
+        if isinstance(key, int):
+            return self.prefix + str(key) + self.suffix
+        return self.prefix + self.quote(key) + self.suffix
+
+    def controls(self, key):
+        return {"self": {"href": self.href(key)}, "profile": self.profile}
+
+def _batches(rows, size):
+    rows = iter(rows)
+    batch = list(itertools.islice(rows, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(rows, size))
+
+def build_items(rows, fields, serializer, key, related=None):
+    """
+    Builds the items of a collection from row tuples.
+
+    : param fields: names of the item fields, each one is either a column of
+    the rows or a key of related
+    : param serializer: CollectionSerializer for the controls, None to leave
+    the controls out
+    : param key: name of the row column the self link is made from
+    : param related: dict from field name to a dict from row id to values
+    """
+
+    related = related or {}
+    items = []
+    for row in rows:
+        item = {}
+        for name in fields:
+            if name in related:
+                item[name] = related[name].get(row.id, [])
+            else:
+                item[name] = getattr(row, name)
+        if serializer is not None:
+            item["@controls"] = serializer.controls(getattr(row, key))
+        items.append(item)
+    return items
+
+def transaction_items(rows, fields=TRANSACTION_FIELDS, controls=True, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields the Mason items of transaction rows made by transaction_rows.
+    Categories are looked up once per batch of rows, so the rows can come
+    from a streamed query too.
+    """
+
+    serializer = None
+    if controls:
+        serializer = CollectionSerializer("api.transactionitem", "transaction_id", TRANSACTION_PROFILE)
+    if fields == TRANSACTION_FIELDS and controls:
+        # the full item is by far the most common, so it gets a fast path
+        for batch in _batches(rows, batch_size):
+            categories = categories_of_transactions([row.id for row in batch])
+            for row_id, price, date_time, sender, receiver in batch:
+                yield {
+                    "id": row_id,
+                    "price": price,
+                    "dateTime": date_time,
+                    "sender": sender if sender is not None else "Null",
+                    "receiver": receiver if receiver is not None else "Null",
+                    "category": categories.get(row_id, []),
+                    "@controls": serializer.controls(row_id)
+                }
+        return
+
+    for batch in _batches(rows, batch_size):
+        related = {}
+        if "category" in fields:
+            related["category"] = categories_of_transactions([row.id for row in batch])
+        for item in build_items(batch, fields, serializer, "id", related):
+            for party in ("sender", "receiver"):
+                if party in item and item[party] is None:
+                    item[party] = "Null"
+            yield item
+
+def user_items(rows, fields=USER_FIELDS, controls=True):
+    rows = list(rows)
+    related = {}
+    if "bankAccount" in fields:
+        related["bankAccount"] = bank_accounts_of_users([row.id for row in rows])
+    serializer = CollectionSerializer("api.useritem", "username", USER_PROFILE) if controls else None
+    return build_items(rows, fields, serializer, "username", related)
+
+def category_items(rows, fields=CATEGORY_FIELDS, controls=True, embed_limit=None):
+    """
+    : param embed_limit: number of transaction ids embedded in each item,
+    None to embed none. The items link to the transactions of the category
+    either way.
+    """
+
+    rows = list(rows)
+    related = {}
+    if embed_limit is not None:
+        fields = fields + ("transaction",)
+        related["transaction"] = transaction_previews_of_categories([row.id for row in rows], embed_limit)
+    serializer = CollectionSerializer("api.categoryitem", "category_name", CATEGORY_PROFILE) if controls else None
+    items = build_items(rows, fields, serializer, "category_name", related)
+    if controls:
+        transactions = CollectionSerializer("api.categorytransactioncollection", "category_name", None)
+        for row, item in zip(rows, items):
+            item["@controls"]["bumeta:transaction-in"] = {"href": transactions.href(row.category_name)}
+    return items
+
+def bank_account_items(rows, fields=BANK_ACCOUNT_FIELDS, controls=True):
+    rows = list(rows)
+    related = {}
+    if "user" in fields:
+        related["user"] = users_of_bank_accounts([row.id for row in rows])
+    serializer = CollectionSerializer("api.bankaccountitem", "iban", BANK_ACCOUNT_PROFILE) if controls else None
+    return build_items(rows, fields, serializer, "iban", related)
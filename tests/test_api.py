@@ -1,17 +1,24 @@
+import gzip
 import json
 import os
 import pytest
+import re
 import tempfile
 import time
 
 from datetime import datetime
-from jsonschema import validate
+from flask import url_for
+from jsonschema import validate, ValidationError
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy.exc import IntegrityError, OperationalError, StatementError
 
 from budgethub import db, create_app
-from budgethub.models import Transaction, BankAccount, User, Category
+from budgethub.metrics import metrics
+from budgethub.profiler import profiler
+from budgethub.replica import read_replica
+from budgethub.utils import schema_registry, TransactionBuilder, JSON_BACKENDS
+from budgethub.models import Transaction, BankAccount, User, Category, SpendingRollup, bump_table_versions, resolve_names
 import tests.utils as utils
 
 
@@ -42,8 +49,11 @@ def client():
         db.create_all()
         populate_db()
         yield app.test_client()
-        
-    db.session.remove()
+        # close the pooled connections so SQLite removes the WAL files
+        db.session.remove()
+        read_replica.dispose()
+        db.get_engine().dispose()
+
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -71,6 +81,476 @@ def populate_db():
     db.session.commit()
 
     
+def _add_rows(count):
+    """
+    Adds count more users, bank accounts, categories and transactions, every
+    one of them with relationships, so that lazy loading would show up as
+    extra queries.
+    """
+
+    for i in range(count):
+        account = utils._get_bankAccount(iban="FX{}".format(i), bankName="The bank")
+        user = utils._get_user(username="extra{}".format(i), password="password")
+        user.bankAccount.append(account)
+        category = utils._get_category(name="extracat{}".format(i))
+        transaction = utils._get_transaction(price=1.0, dateTime=datetime.now(), sender=user, receiver=user,
+                                        category=[category])
+        db.session.add(transaction)
+    bump_table_versions(Transaction, BankAccount, User, Category)
+    db.session.commit()
+    db.session.expunge_all()
+
+
+class TestQueryCounts(object):
+    """
+    Checks that the collection resources run a constant number of queries no
+    matter how many rows and related rows they serialize.
+    """
+
+    URLS = ["/api/transactions/", "/api/users/", "/api/bankaccounts/", "/api/categories/"]
+
+    def test_collections(self, client):
+        small = {}
+        for url in self.URLS:
+            db.session.expunge_all()
+            with utils._count_queries() as statements:
+                resp = client.get(url)
+            assert resp.status_code == 200
+            small[url] = len(statements)
+            assert small[url] <= 3
+
+        _add_rows(20)
+        for url in self.URLS:
+            with utils._count_queries() as statements:
+                resp = client.get(url)
+            assert resp.status_code == 200
+            assert len(json.loads(resp.data)["items"]) > 20
+            assert len(statements) == small[url]
+
+
+class TestSparseFieldsets(object):
+    """
+    Checks that ?fields and ?controls=none shrink both the items and the
+    SQL the collections run.
+    """
+
+    def test_transactions(self, client):
+        with utils._count_queries() as statements:
+            resp = client.get("/api/transactions/?fields=price&controls=none&sort=-price")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["items"] == [{"price": 3.5}]
+        assert "@controls" in body
+        # no users joined, no categories looked up
+        select = [statement for statement in statements if "FROM \"transaction\"" in statement]
+        assert len(select) == 1
+        assert "JOIN" not in select[0] and "dateTime" not in select[0]
+        assert not any("transaction_category_association_table" in statement for statement in statements)
+
+        resp = client.get("/api/transactions/?fields=category,id&limit=1")
+        item = json.loads(resp.data)["items"][0]
+        assert list(item) == ["id", "category", "@controls"]
+        resp = client.get("/api/transactions/?fields=price&stream=1", headers={"Accept": "application/x-ndjson"})
+        assert resp.data == b'{"price":3.5,"@controls":{"self":{"href":"/api/transactions/1/"},' \
+                            b'"profile":{"href":"/profiles/transaction/"}}}\n'
+
+        resp = client.get("/api/transactions/?fields=nothing")
+        assert resp.status_code == 400
+        resp = client.get("/api/transactions/?controls=some")
+        assert resp.status_code == 400
+
+    def test_collections(self, client):
+        with utils._count_queries() as statements:
+            resp = client.get("/api/categories/?fields=category_name&controls=none")
+        assert json.loads(resp.data)["items"] == [{"category_name": "cat1"}, {"category_name": "cat2"}]
+        assert not any("transaction_category_association_table" in statement for statement in statements)
+
+        resp = client.get("/api/users/?fields=balance,username")
+        for item in json.loads(resp.data)["items"]:
+            assert list(item) == ["username", "balance", "@controls"]
+        resp = client.get("/api/bankaccounts/?fields=user&controls=none")
+        assert json.loads(resp.data)["items"] == [{"user": ["user1"]}, {"user": ["user2"]}]
+        resp = client.get("/api/users/?fields=iban")
+        assert resp.status_code == 400
+
+
+class TestConditionalGet(object):
+    """
+    Checks that the resources answer If-None-Match with 304 while the tables
+    they are built from are unchanged, and with a new representation after a
+    write to any of them.
+    """
+
+    URLS = ["/api/transactions/", "/api/users/", "/api/bankaccounts/", "/api/categories/",
+            "/api/users/user1/", "/api/transactions/1/", "/api/reports/totals/"]
+
+    def _etags(self, client):
+        etags = {}
+        for url in self.URLS:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            etags[url] = resp.headers["ETag"]
+            resp = client.get(url, headers={"If-None-Match": etags[url]})
+            assert resp.status_code == 304
+            assert resp.data == b""
+        return etags
+
+    def test_get(self, client):
+        before = self._etags(client)
+        resp = client.get("/api/transactions/?limit=1")
+        assert resp.headers["ETag"] != before["/api/transactions/"]
+
+        # a new category doesn't change users or bank accounts
+        client.post("/api/categories/", json=utils._get_category_json())
+        after = self._etags(client)
+        assert after["/api/categories/"] != before["/api/categories/"]
+        assert after["/api/users/"] == before["/api/users/"]
+        assert after["/api/bankaccounts/"] == before["/api/bankaccounts/"]
+
+        # deleting a user changes the transactions that name them
+        client.delete("/api/users/user2/")
+        resp = client.get("/api/transactions/", headers={"If-None-Match": after["/api/transactions/"]})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"][0]["receiver"] == "Null"
+        resp = client.get("/api/users/XD/", headers={"If-None-Match": after["/api/users/user1/"]})
+        assert resp.status_code == 404
+
+
+class TestResponseCache(object):
+    """
+    Checks that repeated GETs are served from the response cache and that
+    writes evict the cached pages that show the written rows.
+    """
+
+    def _stats(self, client):
+        resp = client.get("/api/cache/")
+        assert resp.status_code == 200
+        return json.loads(resp.data)
+
+    def test_get(self, client):
+        before = self._stats(client)
+        first = client.get("/api/transactions/")
+        second = client.get("/api/transactions/")
+        assert second.data == first.data
+        assert second.headers["ETag"] == first.headers["ETag"]
+        stats = self._stats(client)
+        assert stats["hits"] == before["hits"] + 1
+        assert stats["misses"] == before["misses"] + 1
+        assert stats["bytes"] <= stats["max_bytes"]
+
+        # deleting a user evicts the transaction pages that show their name
+        client.delete("/api/users/user2/")
+        assert self._stats(client)["invalidations"] > stats["invalidations"]
+        resp = client.get("/api/transactions/")
+        assert json.loads(resp.data)["items"][0]["receiver"] == "Null"
+
+    def test_eviction(self, client):
+        app.config["RESPONSE_CACHE_MAX_BYTES"] = 2000
+        try:
+            before = self._stats(client)
+            for url in ["/api/transactions/", "/api/users/", "/api/categories/", "/api/bankaccounts/"]:
+                client.get(url)
+            stats = self._stats(client)
+            assert stats["evictions"] > before["evictions"]
+            assert stats["bytes"] <= 2000
+        finally:
+            app.config["RESPONSE_CACHE_MAX_BYTES"] = 64 * 1024 * 1024
+
+
+class TestMetrics(object):
+    """
+    Checks the per endpoint metrics at /metrics and that the numbers of
+    other worker processes are added up from their files.
+    """
+
+    def _metrics(self, client):
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        values = {}
+        for line in resp.data.decode().splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                values[name] = float(value)
+        return values
+
+    def test_get(self, client):
+        requests = 'budgethub_http_requests_total{endpoint="api.useritem",method="GET",status="200"}'
+        missing = 'budgethub_http_requests_total{endpoint="api.useritem",method="GET",status="404"}'
+        queries = 'budgethub_http_request_sql_queries_sum{endpoint="api.useritem",method="GET"}'
+        latency = 'budgethub_http_request_duration_seconds_bucket{endpoint="api.useritem",method="GET",le="+Inf"}'
+        before = self._metrics(client)
+        client.get("/api/users/user1/")
+        client.get("/api/users/user1/")
+        client.get("/api/users/nobody/")
+        values = self._metrics(client)
+        assert values[requests] == before.get(requests, 0) + 2
+        assert values[missing] == before.get(missing, 0) + 1
+        assert values[latency] == before.get(latency, 0) + 3
+        assert values[queries] > before.get(queries, 0)
+        assert 'budgethub_http_response_size_bytes_count{endpoint="api.useritem",method="GET"}' in values
+
+    def test_streamed(self, client):
+        """
+        Tests that a streamed response is recorded once its body has been
+        sent, with the queries run while sending it.
+        """
+
+        _add_rows(5)
+        requests = 'budgethub_http_requests_total{endpoint="api.transactioncollection",method="GET",status="200"}'
+        queries = 'budgethub_http_request_sql_queries_sum{endpoint="api.transactioncollection",method="GET"}'
+        key = ("budgethub_http_requests_total", ("api.transactioncollection", "GET", "200"))
+        before = self._metrics(client)
+        resp = client.get("/api/transactions/?stream=1", headers={"Accept": "application/x-ndjson"}, buffered=False)
+        assert metrics.counters.get(key, 0) == before.get(requests, 0)
+        assert len(resp.get_data().splitlines()) == Transaction.query.count()
+        resp.close()
+        values = self._metrics(client)
+        assert values[requests] == before.get(requests, 0) + 1
+        assert values[queries] >= before.get(queries, 0) + 1
+
+    def test_processes(self, client):
+        directory = tempfile.mkdtemp()
+        app.config["METRICS_DIR"] = directory
+        try:
+            client.get("/api/users/")
+            key = 'budgethub_http_requests_total{endpoint="api.usercollection",method="GET",status="200"}'
+            own = self._metrics(client)[key]
+            # another worker with the same numbers
+            metrics.flush(directory)
+            os.rename(os.path.join(directory, metrics.filename), os.path.join(directory, "1.json"))
+            assert self._metrics(client)[key] == 2 * own
+        finally:
+            app.config["METRICS_DIR"] = None
+            for filename in os.listdir(directory):
+                os.unlink(os.path.join(directory, filename))
+            os.rmdir(directory)
+
+    def test_reused_pid(self, client):
+        """
+        Tests that a new process with the process id of an exited one
+        doesn't replace its file, so the counters don't go backwards.
+        """
+
+        directory = tempfile.mkdtemp()
+        app.config["METRICS_DIR"] = directory
+        counters, histograms = metrics.counters, metrics.histograms
+        try:
+            client.get("/api/users/")
+            key = 'budgethub_http_requests_total{endpoint="api.usercollection",method="GET",status="200"}'
+            metrics.flush(directory)
+            before = self._metrics(client)[key]
+            # the process exits and a new one gets the same process id
+            metrics.reset()
+            metrics.flush(directory)
+            assert self._metrics(client)[key] == before
+        finally:
+            app.config["METRICS_DIR"] = None
+            metrics.counters, metrics.histograms = counters, histograms
+            for filename in os.listdir(directory):
+                os.unlink(os.path.join(directory, filename))
+            os.rmdir(directory)
+
+
+class TestSQLProfiler(object):
+    """
+    Checks the X-SQL-Profile header, the detection of statements repeated
+    by lazy loading and the slow query log.
+    """
+
+    def test_header(self, client):
+        app.config["SQL_PROFILER_ENABLED"] = True
+        try:
+            resp = client.get("/api/users/")
+            assert re.match(r"^queries=[0-9]+; time_ms=[0-9.]+; slow=0$", resp.headers["X-SQL-Profile"])
+        finally:
+            app.config["SQL_PROFILER_ENABLED"] = False
+        assert "X-SQL-Profile" not in client.get("/api/users/").headers
+
+    def test_repeated(self, client):
+        _add_rows(5)
+        app.config["SQL_PROFILER_ENABLED"] = True
+        try:
+            with app.test_request_context("/api/users/"):
+                profiler.start_request()
+                # one bank account query per user
+                for user in User.query.all():
+                    user.bankAccount
+                resp = profiler.after_request(app.response_class())
+            assert "repeated=" in resp.headers["X-SQL-Profile"]
+            assert resp.headers["X-SQL-Profile"].endswith(" x7")
+        finally:
+            app.config["SQL_PROFILER_ENABLED"] = False
+
+    def test_slow_query_log(self, client):
+        db_fd, log_fname = tempfile.mkstemp()
+        app.config.update(SQL_PROFILER_ENABLED=True, SQL_PROFILER_SLOW_MS=0, SQL_PROFILER_LOG=log_fname)
+        try:
+            resp = client.get("/api/transactions/")
+            assert "slow=0" not in resp.headers["X-SQL-Profile"]
+            with open(log_fname) as f:
+                log = f.read()
+            assert "GET /api/transactions/? at resources/transaction.py" in log
+            assert "plan: " in log
+        finally:
+            app.config.update(SQL_PROFILER_ENABLED=False, SQL_PROFILER_SLOW_MS=100)
+            os.close(db_fd)
+            os.unlink(log_fname)
+
+
+class TestReadReplica(object):
+    """
+    Checks that GET requests read from the read-only replica engine and that
+    writes, and the reads of the same request, run on the primary.
+    """
+
+    def _statements(self, engine, statements):
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        return record
+
+    def test_routing(self, client):
+        primary, replica = [], []
+        primary_engine = db.get_engine()
+        replica_engine = read_replica.get_engine(app)
+        assert replica_engine is not None
+        listeners = [
+            (primary_engine, self._statements(primary_engine, primary)),
+            (replica_engine, self._statements(replica_engine, replica))
+        ]
+        try:
+            resp = client.get("/api/users/")
+            assert resp.status_code == 200
+            assert replica and not primary
+
+            del replica[:]
+            resp = client.post("/api/users/", json={
+                "username": "user3", "password": "password", "bankAccount": ["FI01"]
+            })
+            assert resp.status_code == 201
+            assert primary and not replica
+
+            resp = client.get("/api/users/user3/")
+            assert resp.status_code == 200
+            assert replica
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, "before_cursor_execute", listener)
+
+    def test_read_only(self, client):
+        with read_replica.get_engine(app).connect() as connection:
+            assert connection.execute("SELECT COUNT(*) FROM user").scalar() == 2
+            with pytest.raises(OperationalError):
+                connection.execute("DELETE FROM user")
+
+    def test_disabled(self, client):
+        app.config["READ_REPLICA_ENABLED"] = False
+        try:
+            assert read_replica.get_engine(app) is None
+            resp = client.get("/api/users/")
+            assert resp.status_code == 200
+        finally:
+            app.config["READ_REPLICA_ENABLED"] = True
+
+
+class TestSchemaRegistry(object):
+    """
+    Checks that the schema controls share the precompiled, read-only schemas
+    and that the registry reports the same errors as jsonschema.validate.
+    """
+
+    def test_schemas(self, client):
+        schema = schema_registry.schema("transaction")
+        body = TransactionBuilder()
+        body.add_control_add_transaction()
+        assert body["@controls"]["bumeta:add-transaction"]["schema"] is schema
+        with pytest.raises(TypeError):
+            schema["required"].append("id")
+        with pytest.raises(ValidationError):
+            schema_registry.validate("category", {"name": "x"})
+        resp = client.get("/api/transactions/")
+        validate(utils._get_transaction_json(), json.loads(resp.data)["@controls"]["bumeta:add-transaction"]["schema"])
+
+
+class TestJSONBackends(object):
+    """
+    Checks that every JSON backend writes the same compact bytes for the
+    prices of the test data, with datetimes in ISO 8601.
+    """
+
+    def test_get(self, client):
+        app.config["RESPONSE_CACHE_ENABLED"] = False
+        try:
+            outputs = []
+            for backend in JSON_BACKENDS:
+                app.config["JSON_BACKEND"] = backend
+                resp = client.get("/api/transactions/?stream=1", headers={"Accept": "application/x-ndjson"})
+                outputs.append(resp.data)
+                resp = client.get("/api/transactions/1/")
+                outputs.append(resp.data)
+        finally:
+            app.config["RESPONSE_CACHE_ENABLED"] = True
+            app.config["JSON_BACKEND"] = "auto"
+        assert outputs[0::2] == [outputs[0]] * len(JSON_BACKENDS)
+        assert outputs[1::2] == [outputs[1]] * len(JSON_BACKENDS)
+        assert b'", "' not in outputs[1] and b'": ' not in outputs[1]
+        item = json.loads(outputs[0])
+        assert datetime.fromisoformat(item["dateTime"]).isoformat() == item["dateTime"]
+
+
+class TestCompression(object):
+    """
+    Checks that responses are compressed when the client accepts gzip, that
+    the compressed variant has its own ETag and that streams are compressed
+    as they are written.
+    """
+
+    def test_get(self, client):
+        _add_rows(20)
+        plain = client.get("/api/transactions/")
+        assert "Content-Encoding" not in plain.headers
+        resp = client.get("/api/transactions/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert "Accept-Encoding" in resp.headers["Vary"]
+        assert gzip.decompress(resp.data) == plain.data
+        assert len(resp.data) < len(plain.data) / 4
+        assert resp.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+        resp = client.get("/api/transactions/", headers={
+            "Accept-Encoding": "gzip", "If-None-Match": resp.headers["ETag"]
+        })
+        assert resp.status_code == 304
+
+        # small responses aren't worth it
+        resp = client.get("/api/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+
+        resp = client.get("/api/transactions/?stream=1", headers={
+            "Accept-Encoding": "gzip", "Accept": "application/x-ndjson"
+        })
+        assert resp.headers["Content-Encoding"] == "gzip"
+        lines = gzip.decompress(resp.data).splitlines()
+        assert len(lines) == 21
+
+    def test_get_static(self, client):
+        resp = client.get("/static/scripts/admin.js", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        with open(os.path.join(app.static_folder, "scripts", "admin.js"), "rb") as handle:
+            assert gzip.decompress(resp.data) == handle.read()
+        resp.close()
+
+    def test_get_range(self, client):
+        resp = client.get("/static/scripts/admin.js", headers={
+            "Accept-Encoding": "gzip", "Range": "bytes=0-999"
+        })
+        assert resp.status_code == 206
+        assert "Content-Encoding" not in resp.headers
+        assert resp.headers["Content-Range"].startswith("bytes 0-999/")
+        with open(os.path.join(app.static_folder, "scripts", "admin.js"), "rb") as handle:
+            assert resp.data == handle.read(1000)
+        resp.close()
+
+
 class TestEntryPoint(object):
 
     #Test that the api's entry point is accessible
@@ -274,7 +754,55 @@ class TestCategoryCollection(object):
         for item in body["items"]:
             utils._check_control_get_method("self", client, item)
             utils._check_control_get_method("profile", client, item)
+            utils._check_control_get_method("bumeta:transaction-in", client, item)
             assert "category_name" in item
+            assert "transaction" not in item
+        assert [item["transaction_count"] for item in body["items"]] == [1, 0]
+
+    def test_get_embed(self, client):
+        """
+        Tests that ?embed=transactions embeds the ids of the first limit
+        transactions of each category, and that invalid embeds and limits
+        result in 400.
+        """
+
+        _add_rows(3)
+        for i in range(3):
+            transaction = utils._get_transaction(price=1.0, dateTime=datetime(2020, 1, 3 - i),
+                                           sender=None, receiver=None, category=[Category.query.get(1)])
+            db.session.add(transaction)
+        bump_table_versions(Transaction)
+        db.session.commit()
+
+        resp = client.get(self.RESOURCE_URL + "?embed=transactions&limit=2")
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert items[0]["transaction_count"] == 4
+        sub = json.loads(client.get(items[0]["@controls"]["bumeta:transaction-in"]["href"]).data)
+        assert items[0]["transaction"] == sorted(item["id"] for item in sub["items"])[:2]
+        assert [len(item["transaction"]) for item in items] == [2, 0, 1, 1, 1]
+
+        resp = client.get(self.RESOURCE_URL + "?embed=transactions&fields=category_name&controls=none")
+        assert json.loads(resp.data)["items"][1] == {"category_name": "cat2", "transaction": []}
+
+        assert client.get(self.RESOURCE_URL + "?embed=users").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?embed=transactions&limit=0").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?embed=transactions&limit=x").status_code == 400
+
+    def test_get_quoted(self, client):
+        """
+        Tests that the self links of the items are quoted the same way as
+        url_for quotes them.
+        """
+
+        client.post(self.RESOURCE_URL, json={"category_name": "föö bär?"})
+        resp = client.get(self.RESOURCE_URL)
+        item = json.loads(resp.data)["items"][-1]
+        assert item["category_name"] == "föö bär?"
+        with app.test_request_context():
+            assert item["@controls"]["self"]["href"] == url_for("api.categoryitem", category_name="föö bär?")
+        resp = client.get(item["@controls"]["self"]["href"])
+        assert resp.status_code == 200
 
     def test_post(self, client):
         """
@@ -326,9 +854,16 @@ class TestCategoryItem(object):
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["category_name"] == "cat1"
+        assert body["transaction_count"] == 1
+        assert "transaction" not in body
+        resp = client.get(self.RESOURCE_URL + "?embed=transactions&limit=1")
+        assert json.loads(resp.data)["transaction"] == [1]
+        resp = client.get(self.RESOURCE_URL + "?embed=transaction")
+        assert resp.status_code == 400
         utils._check_namespace(client, body)
         utils._check_control_get_method("profile", client, body)
         utils._check_control_get_method("bumeta:categories-all", client, body)
+        utils._check_control_get_method("bumeta:transaction-in", client, body)
         utils._check_category_control_put_method("edit", client, body)
         utils._check_control_delete_method("bumeta:delete", client, body)
         resp = client.get(self.INVALID_URL)
@@ -461,6 +996,36 @@ class TestUserCollection(object):
 
         
         
+    def test_get_balances(self, client):
+        """
+        Tests that the balances in the collection follow the transactions as
+        they are added and deleted, and that the verification command finds
+        and fixes balances that have drifted.
+        """
+
+        # the populated transaction was added without updating the balances
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["verify-balances"])
+        assert result.exit_code == 1
+        assert "2 of 2 balances drifted" in result.output
+        result = runner.invoke(args=["verify-balances", "--fix"])
+        assert result.exit_code == 0
+
+        valid = utils._get_transaction_json()
+        resp = client.post("/api/transactions/", json=valid)
+        location = resp.headers["Location"]
+        valid.update(sender="user2", receiver="user1", price=1.0)
+        client.post("/api/transactions/bulk/", json=[valid, valid])
+        client.delete(location)
+
+        resp = client.get(self.RESOURCE_URL)
+        balances = {item["username"]: item["balance"] for item in json.loads(resp.data)["items"]}
+        assert balances == {"user1": -1.5, "user2": 1.5}
+        result = runner.invoke(args=["verify-balances"])
+        assert result.exit_code == 0
+        assert "0 of 2 balances drifted" in result.output
+
+
 class TestUserItem(object):
     
     RESOURCE_URL = "/api/users/user1/"
@@ -479,10 +1044,12 @@ class TestUserItem(object):
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["username"] == "user1"
+        assert body["balance"] == 0
         assert body["bankAccount"] == ["FI01"]
         utils._check_namespace(client, body)
         utils._check_control_get_method("profile", client, body)
         utils._check_control_get_method("bumeta:users-all", client, body)
+        utils._check_control_get_method("bumeta:transaction-by", client, body)
         utils._check_user_control_put_method("edit", client, body)
         utils._check_control_delete_method("bumeta:delete", client, body)
         resp = client.get(self.INVALID_URL)
@@ -530,6 +1097,36 @@ class TestUserItem(object):
         body = json.loads(resp.data)
         assert body["username"] == valid["username"]
         
+    def test_put_accounts(self, client):
+        """
+        Tests that PUT replaces the bank accounts of the user, writes only the
+        association rows that change and reports every missing iban at once.
+        """
+
+        body = {"username": "user1", "password": "pw", "bankAccount": ["FI01", "FI02"]}
+        resp = client.put(self.RESOURCE_URL, json=body)
+        assert resp.status_code == 204
+        # relinking an account that is already linked used to fail
+        with utils._count_queries() as statements:
+            resp = client.put(self.RESOURCE_URL, json=body)
+        assert resp.status_code == 204
+        assert not any("bankaccount_user_association_table" in statement
+                       and statement.startswith(("INSERT", "DELETE")) for statement in statements)
+
+        body["bankAccount"] = ["FI02"]
+        with utils._count_queries() as statements:
+            resp = client.put(self.RESOURCE_URL, json=body)
+        assert resp.status_code == 204
+        writes = [statement for statement in statements if "bankaccount_user_association_table" in statement
+                  and statement.startswith(("INSERT", "DELETE"))]
+        assert len(writes) == 1 and writes[0].startswith("DELETE")
+        assert json.loads(client.get(self.RESOURCE_URL).data)["bankAccount"] == ["FI02"]
+
+        body["bankAccount"] = ["FI02", "XX01", "XX02"]
+        resp = client.put(self.RESOURCE_URL, json=body)
+        assert resp.status_code == 404
+        assert "XX01, XX02" in json.loads(resp.data)["@error"]["@messages"][0]
+
     def test_delete(self, client):
         """
         Tests the DELETE method. Checks that a valid request reveives 204
@@ -588,7 +1185,122 @@ class TestTransactionCollection(object):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
 
-            
+
+
+    def test_get_paginated(self, client):
+        """
+        Tests keyset pagination of the GET method. Walks the collection forward
+        with the next controls and back with the prev controls, and checks that
+        every transaction is seen exactly once and in order. Also checks that
+        invalid limits and cursors result in 400.
+        """
+
+        for _ in range(6):
+            resp = client.post(self.RESOURCE_URL, json=utils._get_transaction_json())
+            assert resp.status_code == 201
+
+        seen = []
+        href = self.RESOURCE_URL + "?limit=3"
+        pages = []
+        while href:
+            resp = client.get(href)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert len(body["items"]) <= 3
+            seen.extend(item["id"] for item in body["items"])
+            pages.append(body)
+            href = body["@controls"].get("next", {}).get("href")
+        assert sorted(seen) == list(range(1, 8))
+        assert len(seen) == len(set(seen))
+        assert len(pages) == 3
+        assert "prev" not in pages[0]["@controls"]
+
+        resp = client.get(pages[-1]["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [item["id"] for item in pages[1]["items"]]
+
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=abc")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=notacursor")
+        assert resp.status_code == 400
+
+    def test_get_stream(self, client):
+        """
+        Tests the streaming mode of the GET method. Checks that ?stream=1 gives
+        one Mason document with every transaction and no paging controls, and
+        that accepting NDJSON gives one transaction per line.
+        """
+
+        for _ in range(4):
+            client.post(self.RESOURCE_URL, json=utils._get_transaction_json())
+
+        resp = client.get(self.RESOURCE_URL + "?stream=1&limit=2&sort=-dateTime")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [5, 4, 3, 2, 1]
+        assert "next" not in body["@controls"]
+        utils._check_control_get_method("bumeta:users-all", client, body)
+
+        resp = client.get(self.RESOURCE_URL + "?sender=user1", headers={"Accept": "application/x-ndjson"})
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        lines = resp.data.decode().splitlines()
+        assert len(lines) == 5
+        assert json.loads(lines[0])["id"] == 1
+
+        resp = client.get(self.RESOURCE_URL + "?stream=1&sort=sender")
+        assert resp.status_code == 400
+
+    def test_get_filtered(self, client):
+        """
+        Tests filtering and sorting of the GET method. Checks that every filter
+        narrows the collection down, that sorting by price works in both
+        directions across pages, and that invalid values result in 400.
+        """
+
+        for price, category in [(1.0, "cat2"), (20.0, "cat1"), (5.0, "cat2")]:
+            valid = utils._get_transaction_json()
+            valid["price"] = price
+            valid["sender"] = "user2"
+            valid["receiver"] = "user1"
+            valid["category"] = [category]
+            resp = client.post(self.RESOURCE_URL, json=valid)
+            assert resp.status_code == 201
+
+        def prices(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [item["price"] for item in json.loads(resp.data)["items"]]
+
+        assert sorted(prices("?category=cat2")) == [1.0, 5.0]
+        assert sorted(prices("?sender=user2")) == [1.0, 5.0, 20.0]
+        assert prices("?receiver=user2") == [3.5]
+        assert sorted(prices("?min_price=4&max_price=20")) == [5.0, 20.0]
+        assert prices("?sender=nobody") == []
+        assert len(prices("?from=2000-01-01&to=2999-12-31")) == 4
+        assert prices("?to=2000-01-01") == []
+        assert prices("?sort=price") == [1.0, 3.5, 5.0, 20.0]
+
+        resp = client.get(self.RESOURCE_URL + "?sort=-price&limit=3")
+        body = json.loads(resp.data)
+        assert [item["price"] for item in body["items"]] == [20.0, 5.0, 3.5]
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert [item["price"] for item in json.loads(resp.data)["items"]] == [1.0]
+
+        # cursors only work with the ordering they were made for
+        cursor = body["@controls"]["next"]["href"].split("after=")[1].split("&")[0]
+        resp = client.get(self.RESOURCE_URL + "?after=" + cursor)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?sort=receiver")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?min_price=cheap")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+           
 
     def test_post(self, client):
         """
@@ -628,6 +1340,27 @@ class TestTransactionCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 404
 
+        # every missing name is reported at once, duplicates are ignored
+        valid = utils._get_transaction_json()
+        valid.update(sender=wrong_user, receiver=wrong_user2)
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert "vaarin, xd" in json.loads(resp.data)["@error"]["@messages"][0]
+        valid = utils._get_transaction_json()
+        valid["category"] = ["cat1", "cat1", "cat2"]
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 201
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert sorted(body["category"]) == ["cat1", "cat2"]
+
+        # category names must be strings
+        for category in ([1], [{}]):
+            valid = utils._get_transaction_json()
+            valid["category"] = category
+            resp = client.post(self.RESOURCE_URL, json=valid)
+            assert resp.status_code == 400
+        resolved, missing = resolve_names(Category.categoryName, ["cat1", 1, {}])
+        assert list(resolved) == ["cat1"] and missing == [1, {}]
+
         #remove receiver field to test that it fails
         valid.pop("receiver")
         resp = client.post(self.RESOURCE_URL, json=valid)
@@ -639,6 +1372,202 @@ class TestTransactionCollection(object):
         assert resp.status_code == 400
         
         
+class TestTransactionBulk(object):
+    """
+    This class implements tests for the bulk transaction ingest resource.
+    """
+
+    RESOURCE_URL = "/api/transactions/bulk/"
+    COLLECTION_URL = "/api/transactions/"
+
+    def test_post(self, client):
+        """
+        Tests the POST method with a JSON array. Checks that valid items are
+        created with their own timestamps, that invalid items are reported by
+        index without stopping the batch, and that the wrong content type
+        results in 415.
+        """
+
+        valid = utils._get_transaction_json()
+        items = [
+            dict(valid, datetime="2020-01-02T10:00:00"),
+            dict(valid, sender="vaarin"),
+            dict(valid, category=["cat1", "cat666"]),
+            {"price": "free"},
+            dict(valid, datetime="yesterday"),
+            dict(valid, datetime="2020-01-03", category=["cat1", "cat2"]),
+        ]
+
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(items))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json={"price": 1})
+        assert resp.status_code == 400
+
+        resp = client.post(self.RESOURCE_URL + "?chunk_size=1", json=items)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["created"] == 2
+        assert [error["index"] for error in body["errors"]] == [1, 2, 3, 4]
+        assert body["errors"][0]["message"] == "No user was found with the username(s) vaarin"
+        assert body["errors"][1]["message"] == "No category was found with the categoryname(s) cat666"
+        assert [item["index"] for item in body["items"]] == [0, 5]
+
+        resp = client.get(self.COLLECTION_URL + "?from=2020-01-01&to=2020-01-31")
+        created = json.loads(resp.data)["items"]
+        assert [item["dateTime"] for item in created] == ["2020-01-02T10:00:00", "2020-01-03T00:00:00"]
+        assert created[1]["category"] == ["cat1", "cat2"]
+
+    def test_post_bad_category(self, client):
+        """
+        Tests that items with category names that aren't strings are
+        reported with their index and the rest of the batch is created.
+        """
+
+        valid = utils._get_transaction_json()
+        items = [valid, dict(valid, category=[1]), dict(valid, category=[{}]), valid]
+        resp = client.post(self.RESOURCE_URL, json=items)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["index"] for item in body["items"]] == [0, 3]
+        assert [error["index"] for error in body["errors"]] == [1, 2]
+        for item in body["items"]:
+            transaction = json.loads(client.get("/api/transactions/{}/".format(item["id"])).data)
+            assert transaction["category"] == ["cat1"]
+
+    def test_post_rejected_chunk(self, client):
+        """
+        Tests that a chunk the database rejects is reported for each of its
+        items and rolled back, while the other chunks are still created and
+        counted in the balances.
+        """
+
+        db.session.execute(
+            'CREATE TRIGGER reject_price BEFORE INSERT ON "transaction" WHEN NEW.price = 666 '
+            "BEGIN SELECT RAISE(ABORT, 'rejected price'); END"
+        )
+        db.session.commit()
+        balance = User.query.filter_by(username="user2").first().balance
+        valid = utils._get_transaction_json()
+        items = [dict(valid, price=1.0), dict(valid, price=666), dict(valid, price=2.0), dict(valid, price=4.0)]
+        resp = client.post(self.RESOURCE_URL + "?chunk_size=2", json=items)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["index"] for item in body["items"]] == [2, 3]
+        assert [error["index"] for error in body["errors"]] == [0, 1]
+        assert "rejected price" in body["errors"][0]["message"]
+        assert Transaction.query.filter(Transaction.price.in_([1.0, 666])).count() == 0
+        db.session.expire_all()
+        assert User.query.filter_by(username="user2").first().balance == balance + 6.0
+
+    def test_post_ndjson(self, client):
+        """
+        Tests the POST method with one JSON document per line. Checks that a
+        line that isn't JSON is reported without affecting the others.
+        """
+
+        line = json.dumps(utils._get_transaction_json())
+        data = "\n".join([line, "{not json", "", line]) + "\n"
+        resp = client.post(self.RESOURCE_URL, data=data, content_type="application/x-ndjson")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["created"] == 2
+        assert body["errors"] == [{"index": 1, "message": "Invalid JSON"}]
+        resp = client.get(self.COLLECTION_URL)
+        assert len(json.loads(resp.data)["items"]) == 3
+
+
+class TestCategoryTransactionCollection(object):
+    """
+    This class implements tests for the transactions in category collection
+    resource.
+    """
+
+    RESOURCE_URL = "/api/categories/cat1/transactions/"
+    EMPTY_URL = "/api/categories/cat2/transactions/"
+    INVALID_URL = "/api/categories/XD/transactions/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks that only the transactions of the category
+        are listed, that the controls work, and that the list is paginated.
+        Also checks that an unknown category results in 404.
+        """
+
+        for _ in range(3):
+            client.post("/api/transactions/", json=utils._get_transaction_json())
+        valid = utils._get_transaction_json()
+        valid["category"] = ["cat2"]
+        client.post("/api/transactions/", json=valid)
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("bumeta:category", client, body)
+        utils._check_control_get_method("bumeta:transactions-all", client, body)
+        assert len(body["items"]) == 4
+        for item in body["items"]:
+            assert item["category"] == ["cat1"]
+            utils._check_control_get_method("self", client, item)
+
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 3
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert len(json.loads(resp.data)["items"]) == 1
+
+        resp = client.get(self.EMPTY_URL)
+        assert len(json.loads(resp.data)["items"]) == 1
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL + "?limit=-1")
+        assert resp.status_code == 400
+
+
+class TestUserTransactionCollection(object):
+    """
+    This class implements tests for the transactions by user collection
+    resource.
+    """
+
+    RESOURCE_URL = "/api/users/user2/transactions/"
+    INVALID_URL = "/api/users/XD/transactions/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks that the transactions the user sent and
+        received are listed and nothing else, and that the controls work. Also
+        checks that an unknown user results in 404.
+        """
+
+        resp = client.post("/api/users/", json=utils._get_user_json())
+        assert resp.status_code == 201
+        valid = utils._get_transaction_json()
+        valid["receiver"] = "user3"
+        client.post("/api/transactions/", json=valid)
+        valid["sender"] = "user2"
+        client.post("/api/transactions/", json=valid)
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("self", client, body)
+        utils._check_control_get_method("bumeta:user", client, body)
+        utils._check_control_get_method("bumeta:transactions-all", client, body)
+        assert len(body["items"]) == 2
+        for item in body["items"]:
+            assert "user2" in (item["sender"], item["receiver"])
+
+        resp = client.get(self.RESOURCE_URL + "?sort=-dateTime&limit=1")
+        body = json.loads(resp.data)
+        assert body["items"][0]["sender"] == "user2"
+
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+
 class TestTransactionItem(object):
     
     RESOURCE_URL = "/api/transactions/1/"
@@ -728,3 +1657,164 @@ class TestTransactionItem(object):
         assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404        
+
+
+class TestReportTotals(object):
+    """
+    This class implements tests for the spending report resource.
+    """
+
+    RESOURCE_URL = "/api/reports/totals/"
+
+    def _post(self, client, price, datetime, sender, categories):
+        valid = utils._get_transaction_json()
+        valid.update(price=price, datetime=datetime, sender=sender, category=categories)
+        resp = client.post("/api/transactions/bulk/", json=[valid])
+        assert json.loads(resp.data)["created"] == 1
+
+    def _totals(self, client, query=""):
+        resp = client.get(self.RESOURCE_URL + query)
+        assert resp.status_code == 200
+        return [
+            {key: value for key, value in item.items() if key != "@controls"}
+            for item in json.loads(resp.data)["items"]
+        ]
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the totals for different groupings as
+        transactions are added and deleted, and that the rollup rebuilt from
+        scratch by the CLI command gives the same totals. Also checks that
+        unknown groupings result in 400.
+        """
+
+        # the populated transaction was added without going through the API
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=["rebuild-rollups"])
+        assert result.exit_code == 0
+
+        self._post(client, 10.0, "2021-01-15", "user1", ["cat1", "cat2"])
+        self._post(client, 5.0, "2021-02-01", "user1", ["cat2"])
+        self._post(client, 2.5, "2021-02-03", "user2", [])
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("bumeta:transactions-all", client, body)
+        utils._check_control_get_method("bumeta:categories-all", client, body)
+
+        by_user = self._totals(client, "?group_by=user&to=2021-12")
+        assert by_user == [
+            {"user": "user1", "total": 15.0, "count": 2},
+            {"user": "user2", "total": 2.5, "count": 1}
+        ]
+        by_category = self._totals(client, "?group_by=category,month&to=2021-12")
+        assert by_category == [
+            {"category": "cat1", "month": "2021-01", "total": 10.0, "count": 1},
+            {"category": "cat2", "month": "2021-01", "total": 10.0, "count": 1},
+            {"category": "cat2", "month": "2021-02", "total": 5.0, "count": 1}
+        ]
+        assert self._totals(client, "?from=2021-02&to=2021-02") == [{"total": 7.5, "count": 2}]
+
+        resp = client.get("/api/transactions/?from=2021-01-01&to=2021-01-31")
+        transaction_id = json.loads(resp.data)["items"][0]["id"]
+        client.delete("/api/transactions/{}/".format(transaction_id))
+        expected = self._totals(client, "?group_by=category,user,month")
+        assert {"category": "cat1", "user": "user1", "month": "2021-01", "total": 10.0, "count": 1} not in expected
+
+        result = runner.invoke(args=["rebuild-rollups"])
+        assert result.exit_code == 0
+        assert self._totals(client, "?group_by=category,user,month") == expected
+
+        resp = client.get(self.RESOURCE_URL + "?group_by=price")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?from=2021")
+        assert resp.status_code == 400
+
+    def test_deleted_senders(self, client):
+        """
+        Tests that the totals of deleted senders are merged into one group
+        without a sender, so deleting their transactions later takes the
+        right amounts off.
+        """
+
+        client.post("/api/users/", json=utils._get_user_json("sender1"))
+        client.post("/api/users/", json=utils._get_user_json("sender2"))
+        self._post(client, 10.0, "2021-03-01", "sender1", ["cat2"])
+        self._post(client, 20.0, "2021-03-02", "sender2", ["cat2"])
+        assert client.delete("/api/users/sender1/").status_code == 204
+        assert client.delete("/api/users/sender2/").status_code == 204
+        assert self._totals(client, "?from=2021-03&to=2021-03") == [{"total": 30.0, "count": 2}]
+        assert SpendingRollup.query.filter_by(userId=None, categoryId=None).count() == 1
+
+        resp = client.get("/api/transactions/?min_price=20&max_price=20")
+        client.delete("/api/transactions/{}/".format(json.loads(resp.data)["items"][0]["id"]))
+        assert self._totals(client, "?from=2021-03&to=2021-03") == [{"total": 10.0, "count": 1}]
+        assert self._totals(client, "?group_by=category&from=2021-03&to=2021-03") == [
+            {"category": "cat2", "total": 10.0, "count": 1}
+        ]
+
+
+class TestSearch(object):
+    """
+    This class implements tests for the search resource.
+    """
+
+    RESOURCE_URL = "/api/search/"
+
+    def _names(self, client, query):
+        resp = client.get(self.RESOURCE_URL + query)
+        assert resp.status_code == 200
+        return sorted((item["kind"], item["name"]) for item in json.loads(resp.data)["items"])
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks prefix matches of every kind, the kind
+        filter and the limit, and that the links of the results work. Also
+        checks that a missing query, unknown kinds and invalid limits result
+        in 400.
+        """
+
+        resp = client.get(self.RESOURCE_URL + "?q=us")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        utils._check_namespace(client, body)
+        utils._check_control_get_method("bumeta:users-all", client, body)
+        utils._check_control_get_method("bumeta:categories-all", client, body)
+        utils._check_control_get_method("bumeta:bank-accounts-all", client, body)
+        assert [item["kind"] for item in body["items"]] == ["user", "user"]
+        for item in body["items"]:
+            assert client.get(item["@controls"]["self"]["href"]).status_code == 200
+
+        assert self._names(client, "?q=CAT") == [("category", "cat1"), ("category", "cat2")]
+        assert self._names(client, "?q=fi02") == [("bankaccount", "FI02")]
+        assert self._names(client, "?q=the+ba") == [("bankaccount", "FI01"), ("bankaccount", "FI02")]
+        assert self._names(client, "?q=user1+bank") == []
+        assert self._names(client, "?q=us&kind=category,bankaccount") == []
+        assert self._names(client, "?q=cat&kind=user,category") == [("category", "cat1"), ("category", "cat2")]
+        assert len(self._names(client, "?q=us&limit=1")) == 1
+
+        assert client.get(self.RESOURCE_URL).status_code == 400
+        assert client.get(self.RESOURCE_URL + "?q=%20-").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?q=us&kind=transaction").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?q=us&limit=0").status_code == 400
+
+    def test_sync(self, client):
+        """
+        Tests that the index follows the users, categories and bank accounts
+        as they are added, renamed and deleted through the API.
+        """
+
+        client.post("/api/categories/", json={"category_name": "groceries"})
+        assert self._names(client, "?q=groc") == [("category", "groceries")]
+
+        client.put("/api/users/user1/", json={"username": "alice", "password": "x", "bankAccount": []})
+        assert self._names(client, "?q=ali") == [("user", "alice")]
+        assert self._names(client, "?q=user") == [("user", "user2")]
+
+        client.put("/api/bankaccounts/FI01/", json={"iban": "FI01", "bankName": "Nordea"})
+        assert self._names(client, "?q=nord") == [("bankaccount", "FI01")]
+
+        client.delete("/api/categories/groceries/")
+        client.delete("/api/bankaccounts/FI01/")
+        assert self._names(client, "?q=groc") == []
+        assert self._names(client, "?q=nord") == []
@@ -7,9 +7,13 @@ from datetime import datetime
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
+from sqlalchemy.pool import QueuePool
 
 from budgethub import db, create_app
-from budgethub.models import Transaction, BankAccount, User, Category
+from budgethub.replica import read_replica
+from budgethub import datagen, migrations
+from budgethub.constants import SCHEMA_VERSION
+from budgethub.models import Transaction, BankAccount, User, Category, SpendingRollup, search, computed_balances
 import tests.utils as utils
 
 app = create_app()
@@ -30,8 +34,11 @@ def client():
     with app.app_context():
         db.create_all()
         yield app.test_client()
-        
-    db.session.remove()
+        # close the pooled connections so SQLite removes the WAL files
+        db.session.remove()
+        read_replica.dispose()
+        db.get_engine().dispose()
+
     os.close(db_fd)
     os.unlink(db_fname)
 
@@ -227,4 +234,126 @@ def test_errors(client):
     db.session.add(transaction)
     with pytest.raises(StatementError):
         db.session.commit()
-    db.session.rollback()
\ No newline at end of file
+    db.session.rollback()
+
+
+def test_engine_profile(client):
+    """
+    Tests that file based SQLite databases get the production engine profile:
+    WAL journaling, the busy timeout, enforced foreign keys and a connection pool.
+    """
+    with db.engine.connect() as connection:
+        assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+        assert connection.execute("PRAGMA foreign_keys").scalar() == 1
+        assert connection.execute("PRAGMA busy_timeout").scalar() == 5000
+        assert connection.execute("PRAGMA synchronous").scalar() == 1
+    assert isinstance(db.engine.pool, QueuePool)
+
+def test_engine_options_override():
+    """
+    Tests that engine options given in the config only replace the defaults
+    they name.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    custom = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": 10, "pool_pre_ping": True}
+    })
+    try:
+        with custom.app_context():
+            assert isinstance(db.engine.pool, QueuePool)
+            assert db.engine.pool.size() == 10
+            assert custom.config["SQLALCHEMY_ENGINE_OPTIONS"]["max_overflow"] == 10
+            db.get_engine().dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_migrations(client):
+    """
+    Tests that the migrations take a database down to the base tables and
+    back up to the latest schema, filling the balances and the rollup from
+    the transactions on the way up.
+    """
+    assert migrations.LATEST_VERSION == SCHEMA_VERSION
+    user1 = utils._get_user(username="user1", password="password")
+    user2 = utils._get_user(username="user2", password="password2")
+    category = utils._get_category(name="cat1")
+    for month in (1, 2):
+        db.session.add(utils._get_transaction(price=2.5, dateTime=datetime(2020, month, 15), sender=user1,
+                                        receiver=user2, category=[category]))
+    db.session.commit()
+    migrations.set_schema_version(SCHEMA_VERSION)
+
+    migrations.downgrade(1)
+    assert migrations.schema_version() == 1
+    assert "balance" not in migrations.column_names("user")
+    assert [row[0] for row in db.session.execute('SELECT username FROM "user" ORDER BY id')] == ["user1", "user2"]
+    assert db.session.execute("PRAGMA foreign_key_check").fetchall() == []
+    assert not db.engine.has_table("spending_rollup")
+    with pytest.raises(ValueError):
+        migrations.downgrade(0)
+
+    applied = migrations.upgrade()
+    assert [migration.version for migration in applied] == list(range(2, SCHEMA_VERSION + 1))
+    assert migrations.schema_version() == SCHEMA_VERSION
+    db.session.expire_all()
+    assert User.query.filter_by(username="user1").first().balance == -5.0
+    assert User.query.filter_by(username="user2").first().balance == 5.0
+    assert SpendingRollup.query.filter_by(categoryId=None).count() == 2
+    indexes = [row[0] for row in db.session.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+    for name, table, columns in migrations.LOOKUP_INDEXES:
+        assert name in indexes
+    assert sorted(search(["us"])) == [("user", "user1"), ("user", "user2")]
+    assert migrations.upgrade() == []
+
+    # rows of deleted senders that share a group are merged
+    migrations.downgrade(5)
+    for total in (1.0, 2.0):
+        db.session.add(SpendingRollup(month="2019-01", userId=None, categoryId=None, total=total, count=1))
+    db.session.commit()
+    migrations.upgrade()
+    rows = SpendingRollup.query.filter_by(month="2019-01").all()
+    assert [(row.total, row.count) for row in rows] == [(3.0, 2)]
+    with pytest.raises(IntegrityError):
+        db.session.add(SpendingRollup(month="2019-01", userId=None, categoryId=None, total=1.0, count=1))
+        db.session.commit()
+    db.session.rollback()
+
+def test_generate_data(client, monkeypatch):
+    """
+    Tests that the generator gives the same rows for the same seed whether
+    the transactions are generated in one process or in several, and that
+    the balances and the rollup match the generated transactions.
+    """
+    monkeypatch.setattr(datagen, "GENERATE_CHUNK_SIZE", 100)
+    datagen.generate_data(users=30, categories=10, transactions=450, seed=1)
+    rows = [tuple(row) for row in db.session.execute(
+        'SELECT t.*, a."categoryId" FROM "transaction" AS t '
+        'LEFT JOIN transaction_category_association_table AS a ON a."transactionId" = t.id ORDER BY t.id, 6'
+    )]
+    assert Transaction.query.count() == 450
+    assert User.query.count() == 30 and BankAccount.query.count() == 30
+    # popular categories come first
+    assert len(Category.query.get(1).transaction) > len(Category.query.get(10).transaction)
+    balances = computed_balances()
+    for user in User.query:
+        assert user.balance == pytest.approx(balances[user.id])
+    assert SpendingRollup.query.count() > 0
+    with pytest.raises(ValueError):
+        datagen.generate_data(users=30, categories=10, transactions=450, seed=1)
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    result = app.test_cli_runner().invoke(args=[
+        "generate-data", "--users", "30", "--categories", "10", "--transactions", "450", "--seed", "1",
+        "--workers", "2"
+    ])
+    assert result.exit_code == 0
+    assert [tuple(row) for row in db.session.execute(
+        'SELECT t.*, a."categoryId" FROM "transaction" AS t '
+        'LEFT JOIN transaction_category_association_table AS a ON a."transactionId" = t.id ORDER BY t.id, 6'
+    )] == rows
+    result = app.test_cli_runner().invoke(args=["generate-data", "--users", "30"])
+    assert result.exit_code == 1
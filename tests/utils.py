@@ -1,4 +1,9 @@
+from contextlib import contextmanager
 from jsonschema import validate
+from sqlalchemy import event
+from flask import current_app
+from budgethub import db
+from budgethub.replica import read_replica
 from budgethub.models import Transaction, BankAccount, User, Category
 
 #Creates bankaccount database item    
@@ -31,6 +36,29 @@ def _get_transaction(price, dateTime, sender, receiver, category):
         category=category
     )
 
+@contextmanager
+def _count_queries():
+    """
+    Counts the SQL statements executed inside the with block on the primary
+    and the read replica. Yields a list that holds the executed statements
+    once the block has finished.
+    """
+
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = [db.get_engine(), read_replica.get_engine(current_app)]
+    engines = [engine for engine in engines if engine is not None]
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", _record)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", _record)
+
 def _get_bankaccount_json(iban="FI03"):
     """
     Creates a valid bankaccount JSON object to be used for POST tests.